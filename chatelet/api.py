@@ -1,22 +1,41 @@
+import hashlib
+import time
+from collections import defaultdict
 from uuid import uuid4
 from urllib.parse import urlparse
 
-from aiohttp import web, ClientSession, ClientTimeout
+from aiohttp import web
 from aiohttp_apispec import (
     docs,
     request_schema,
     setup_aiohttp_apispec,
     validation_middleware,
     headers_schema,
+    querystring_schema,
 )
-from jsonpath2.path import Path
 
+from chatelet import breaker
+from chatelet import coalesce
+from chatelet import deadletters
 from chatelet import config
 from chatelet import schemas
+from chatelet import streams
+from chatelet import tracing
 from chatelet import utils
 from chatelet import events
-from chatelet.db import Subscription
-from chatelet.queue import queue, retry
+from chatelet import metrics
+from chatelet import routing
+from chatelet.db import db, Delivery, Subscription
+# dispatch and validate_intent are also imported for jobs queued as `chatelet.api.*`
+from chatelet.dispatch import (  # noqa
+    HEADER_SECRET,
+    HEADER_SIGNATURE,
+    dispatch,
+    fanout,
+    fanout_many,
+    validate_intent,
+)
+from chatelet.queue import queue, queue_for, retry
 from chatelet.log import log
 
 routes = web.RouteTableDef()
@@ -25,22 +44,21 @@ if config.EAGER_QUEUES:
     import nest_asyncio
     nest_asyncio.apply()
 
-HEADER_SECRET = "x-hook-secret"
-HEADER_SIGNATURE = "x-hook-signature"
 
+def page(request, rows, schema, limit):
+    """JSON response of a page of `rows` (ordered by id)
 
-async def validate_intent(sub):
-    async with ClientSession(raise_for_status=True, timeout=ClientTimeout(total=15)) as client:
-        log.debug("Validating intent for %s (%s)", sub.url, sub.id)
-        res = await client.post(sub.url, json={"intention": "pure"}, headers={
-            HEADER_SECRET: sub.secret
-        })
-        if res.ok and res.headers.get('x-hook-secret') == sub.secret:
-            sub = await Subscription.get(sub.id)
-            await sub.update(active=True).apply()
-            log.debug("Intent validated for %s (%s)", sub.url, sub.id)
-        else:
-            raise ValueError(f"Intent _not_ validated for {sub.url} ({sub.id})")
+    With an ETag, and a Link to the next page if this one is full.
+    """
+    body = utils.dumps(schema.dump(rows, many=True))
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    if request.headers.get("If-None-Match") == etag:
+        raise web.HTTPNotModified(headers={"ETag": etag})
+    headers = {"ETag": etag}
+    if len(rows) == limit:
+        url = request.rel_url.update_query(after=rows[-1].id, limit=limit)
+        headers["Link"] = f'<{url}>; rel="next"'
+    return web.Response(body=body, headers=headers, content_type="application/json")
 
 
 @routes.view("/subscriptions/")
@@ -48,17 +66,46 @@ class SubscriptionsView(web.View):
     @docs(
         tags=["subscribe"],
         summary="List subscriptions",
+        description=(
+            "Subscriptions are ordered by id and paginated: the `Link` header "
+            "points to the next page (`after` the last id). "
+            "`stream` returns every subscription as NDJSON instead."
+        ),
         responses={
             200: {
                 "schema": schemas.AddSubscriptionResponse(many=True),
                 "description": "List of subscriptions",
             },
+            304: {"description": "Page not modified (If-None-Match)"},
         },
     )
+    @querystring_schema(schemas.SubscriptionsQuery())
     async def get(self):
-        subs = await Subscription.query.gino.all()
-        res = schemas.AddSubscriptionResponse().dump(subs, many=True)
-        return web.json_response(res)
+        params = self.request["querystring"]
+        subs = Subscription.query.order_by(Subscription.id)
+        if "after" in params:
+            subs = subs.where(Subscription.id > params["after"])
+        if "event" in params:
+            subs = subs.where(Subscription.event == params["event"])
+        if "active" in params:
+            subs = subs.where(Subscription.active == params["active"])
+        if params.get("stream"):
+            return await self.stream(subs)
+
+        limit = params.get("limit", config.SUBSCRIPTIONS_PAGE_SIZE)
+        subs = await subs.limit(limit).gino.all()
+        return page(self.request, subs, schemas.AddSubscriptionResponse(), limit)
+
+    async def stream(self, subs):
+        """Write `subs` rows as NDJSON while iterating a database cursor"""
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(self.request)
+        schema = schemas.AddSubscriptionResponse()
+        async with db.transaction():
+            async for sub in subs.gino.iterate():
+                await response.write(utils.dumps(schema.dump(sub)) + b"\n")
+        await response.write_eof()
+        return response
 
     @docs(
         tags=["subscribe"],
@@ -86,7 +133,8 @@ class SubscriptionsView(web.View):
     @request_schema(schemas.AddSubscription())
     async def post(self):
         data = self.request["data"]
-        if not events.get(data["event"]):
+        # patterns (`ns.*`, `ns.**`) subscribe to events below a declared namespace
+        if not events.get(events.namespace(data["event"])):
             raise web.HTTPNotFound()
 
         sub = Subscription.query
@@ -102,11 +150,15 @@ class SubscriptionsView(web.View):
         if not any([parsed.netloc.endswith(d) for d in config.ALLOWED_DOMAINS]):
             raise web.HTTPForbidden()
 
+        if data.get("batch_size") and not data.get("batch_wait"):
+            data["batch_wait"] = config.BATCH_WAIT
         data["active"] = not config.VALIDATION_OF_INTENT
         data["secret"] = str(uuid4())
         sub = await Subscription.create(**data)
+        if sub.active:
+            routing.invalidate(sub.event)
         if config.VALIDATION_OF_INTENT and config.VALIDATION_OF_INTENT_IMMEDIATE:
-            queue().enqueue(validate_intent, sub, retry=retry)
+            queue(config.VALIDATION_QUEUE).enqueue(validate_intent, sub, retry=retry)
         res = schemas.AddSubscriptionResponse().dump(sub)
         return web.json_response(res, status=201)
 
@@ -132,6 +184,8 @@ async def activate_subscription(request):
         raise web.HTTPNotFound()
     if request.headers.get(HEADER_SECRET) == sub.secret:
         await sub.update(active=True).apply()
+        breaker.reset(sub.id)
+        routing.invalidate(sub.event)
         log.debug("Intent validated for %s (%s)", sub.url, sub.id)
         return web.json_response({"ok": True})
     else:
@@ -139,32 +193,129 @@ async def activate_subscription(request):
         raise web.HTTPUnprocessableEntity(reason="Hook secret not matched")
 
 
-async def dispatch(subscription, data):
-    """Dispatch an event to a subscription
+@docs(
+    tags=["subscribe"],
+    summary="Circuit breakers of a subscription",
+    description=(
+        "State of the circuit breakers of the subscription and of its host: "
+        "`closed`, `open` (deliveries are parked), `half-open` (a trial delivery "
+        "is allowed) or `deactivated` (after too many consecutive failures)."
+    ),
+    responses={
+        200: {"schema": schemas.BreakersResponse(), "description": "Breakers state"},
+        404: {"description": "Not found"},
+    },
+)
+@routes.get(r"/subscriptions/{id:\d+}/breaker/")
+async def subscription_breaker(request):
+    sub = await Subscription.get(int(request.match_info["id"]))
+    if not sub:
+        raise web.HTTPNotFound()
+    host = urlparse(sub.url).hostname
+    return web.json_response(schemas.BreakersResponse().dump({
+        "subscription": breaker.status("subscription", sub.id),
+        "host": {"host": host, **breaker.status("host", host)},
+    }))
 
-    NB: using a new ClientSession for each dispatch is suboptimal
-    but how to reuse a session in worker threads?
-    """
-    async with ClientSession(raise_for_status=True, timeout=ClientTimeout(total=15)) as client:
-        log.debug("Dispatching %s to %s (%s)",
-                  subscription.event, subscription.url, subscription.id)
-        if subscription.event_filter:
-            q = Path.parse_str(subscription.event_filter).match(data["payload"])
-            if not list(q):
-                log.debug("Skipped because of event filter: %s", subscription.event_filter)
-                return
-        payload = {
-            "ok": True,
-            "event": subscription.event,
-            "event_filter": subscription.event_filter,
-            "subscription": subscription.id,
-            "payload": data["payload"],
-        }
-        if subscription.secret:
-            sig = utils.sign(payload, subscription.secret)
-        await client.post(subscription.url, json=payload, headers={
-            HEADER_SIGNATURE: sig
-        })
+
+@docs(
+    tags=["subscribe"],
+    summary="Replay the publications to a subscription",
+    description=(
+        "Delivers again the publications matching the subscription from a stream "
+        "offset (an entry id or a unix timestamp in ms), eg after a downtime. "
+        "Needs the streams broker, which keeps the history of publications."
+    ),
+    responses={
+        202: {"description": "Replay enqueued"},
+        404: {"description": "Not found"},
+        409: {"description": "Publications are not kept by the broker"},
+        422: {"description": "Validation error"},
+    },
+)
+@request_schema(schemas.ReplaySubscription())
+@routes.post(r"/subscriptions/{id:\d+}/replay/")
+async def replay_subscription(request):
+    sub = await Subscription.get(int(request.match_info["id"]))
+    if not sub or not sub.active:
+        raise web.HTTPNotFound()
+    if config.BROKER != "streams":
+        raise web.HTTPConflict(reason="Replay needs the streams broker")
+    since = request["data"]["since"]
+    queue_for(events.namespace(sub.event)).enqueue(streams.replay, sub.id, since, retry=retry)
+    return web.json_response({"ok": True}, status=202)
+
+
+@docs(
+    tags=["deliveries"],
+    summary="List dead letters",
+    description=(
+        "Deliveries failed after all their retries, counted by subscription "
+        "(with the last error) and by host."
+    ),
+    responses={
+        200: {"schema": schemas.DeadLettersResponse(), "description": "Dead letters counts"},
+    },
+)
+@querystring_schema(schemas.DeadLettersQuery())
+@routes.get("/deadletters/")
+async def list_deadletters(request):
+    params = request["querystring"]
+    if "subscription" in params:
+        ids = [params["subscription"]]
+    else:
+        ids = deadletters.subscriptions(params.get("host"))
+    found = deadletters.summary(ids)
+    hosts = defaultdict(int)
+    for item in found:
+        hosts[item["host"]] += item["count"]
+    return web.json_response(schemas.DeadLettersResponse().dump({
+        "count": sum(hosts.values()),
+        "hosts": [{"host": host, "count": count} for host, count in sorted(hosts.items())],
+        "subscriptions": found,
+    }))
+
+
+@docs(
+    tags=["deliveries"],
+    summary="Redrive dead letters",
+    description=(
+        "Deliver again the dead letters of a subscription, or of every subscription "
+        "on a host. They are delivered oldest first, at "
+        "`config.DEAD_LETTER_REDRIVE_RATE` deliveries per second per subscription. "
+        "Inactive subscriptions (eg deactivated after too many failures) are skipped: "
+        "activate them first."
+    ),
+    responses={
+        202: {"schema": schemas.RedriveResponse(), "description": "Redrive enqueued"},
+        409: {"description": "The subscription is inactive"},
+        422: {"description": "Validation error"},
+    },
+)
+@request_schema(schemas.RedriveDeadLetters())
+@routes.post("/deadletters/redrive/")
+async def redrive_deadletters(request):
+    data = request["data"]
+    if "subscription" in data:
+        ids = [data["subscription"]]
+    else:
+        ids = deadletters.subscriptions(data["host"])
+    found = deadletters.summary(ids)
+    active = set()
+    if found:
+        subs = Subscription.query.where(Subscription.active.is_(True))
+        subs = subs.where(Subscription.id.in_([item["subscription"] for item in found]))
+        active = {sub.id for sub in await subs.gino.all()}
+    if "subscription" in data and found and not active:
+        raise web.HTTPConflict(reason="Subscription is inactive, activate it first")
+    redriven = [item for item in found if item["subscription"] in active]
+    for item in redriven:
+        queue().enqueue(deadletters.redrive, item["subscription"], retry=retry)
+    return web.json_response(schemas.RedriveResponse().dump({
+        "subscriptions": [item["subscription"] for item in redriven],
+        "count": sum(item["count"] for item in redriven),
+        "inactive": [item["subscription"] for item in found if item not in redriven],
+    }), status=202)
 
 
 @routes.view("/publications/")
@@ -174,9 +325,13 @@ class PublicationsView(web.View):
         summary="Publish an event",
         responses={
             201: {
-                "description": "Publication created",
-                # dummy to document the dispatch payload
-                # TODO: document x-hook-signature
+                "description": "Publication created, with its id",
+                "schema": schemas.PublicationCreated(),
+            },
+            # dummy to document the dispatch payload
+            # TODO: document x-hook-signature
+            "default": {
+                "description": "Not a response: the payload dispatched to subscribers",
                 "schema": schemas.DispatchEvent(),
             },
             401: {"description": "x-hook-signature not matched"},
@@ -186,7 +341,9 @@ class PublicationsView(web.View):
     )
     @headers_schema(schemas.HookSignatureSchema())
     @request_schema(schemas.AddPublication())
+    @metrics.timed(metrics.publish_single)
     async def post(self):
+        started = time.perf_counter()
         data = self.request["data"]
         event = events.get(data["event"])
         if not event:
@@ -195,17 +352,149 @@ class PublicationsView(web.View):
         secret = event.get("secret")
         if not secret:
             raise web.HTTPUnauthorized()
-        sig = utils.sign(await self.request.json(), secret)
-        if self.request.headers.get(HEADER_SIGNATURE) != sig:
+        body = await self.request.read()
+        if not utils.verify(body, secret, self.request.headers.get(HEADER_SIGNATURE)):
             raise web.HTTPUnauthorized()
 
+        data["id"] = str(uuid4())
         log.debug("Publishing: %s", data)
-        subs = Subscription.query\
-            .where(Subscription.event == data["event"])\
-            .where(Subscription.active == True)  # noqa
-        for sub in await subs.gino.all():
-            queue().enqueue(dispatch, sub, data, retry=retry)
-        raise web.HTTPCreated()
+        tracing.published([data], time.perf_counter() - started)
+        if not coalesce.hold(data, event):
+            with metrics.enqueue_fanout.time():
+                if config.BROKER == "streams":
+                    streams.append([data])
+                else:
+                    queue_for(data["event"]).enqueue(fanout, data, retry=retry)
+        return web.json_response({"id": data["id"]}, status=201)
+
+
+@routes.view("/publications/batch/")
+class PublicationsBatchView(web.View):
+    @docs(
+        tags=["publish"],
+        summary="Publish a batch of events",
+        description=(
+            "x-hook-signature signs the whole body, with the secret of the events. "
+            "Events with another secret are rejected (401 in the item result)."
+        ),
+        responses={
+            200: {
+                "description": "Result of each publication, in order",
+                "schema": schemas.PublicationResult(many=True),
+            },
+            401: {"description": "x-hook-signature not matched"},
+            422: {"description": "Validation error"},
+        },
+    )
+    @headers_schema(schemas.HookSignatureSchema())
+    @request_schema(schemas.AddPublication(many=True), put_into="publications")
+    @metrics.timed(metrics.publish_batch)
+    async def post(self):
+        started = time.perf_counter()
+        publications = self.request["publications"]
+        if len(publications) > config.PUBLICATIONS_BATCH_MAX:
+            raise web.HTTPUnprocessableEntity(
+                reason=f"More than {config.PUBLICATIONS_BATCH_MAX} publications"
+            )
+
+        body = await self.request.read()
+        signature = self.request.headers.get(HEADER_SIGNATURE)
+        # secret -> signature matched, each secret checked once for the whole batch
+        verified = {}
+        results, created = [], []
+        for data in publications:
+            event = events.get(data["event"])
+            if not event:
+                results.append({"event": data["event"], "status": 404})
+                continue
+            secret = event.get("secret")
+            if secret and secret not in verified:
+                verified[secret] = utils.verify(body, secret, signature)
+            if not secret or not verified[secret]:
+                results.append({"event": data["event"], "status": 401})
+                continue
+            data["id"] = str(uuid4())
+            results.append({"id": data["id"], "event": data["event"], "status": 201})
+            created.append((data, event))
+        if verified and not any(verified.values()):
+            raise web.HTTPUnauthorized()
+
+        tracing.published([data for data, _ in created], time.perf_counter() - started)
+        accepted = [data for data, event in created if not coalesce.hold(data, event)]
+
+        if accepted and config.BROKER == "streams":
+            log.debug("Appending %s event(s) in batch", len(accepted))
+            with metrics.enqueue_fanout.time():
+                streams.append(accepted)
+        elif accepted:
+            log.debug("Publishing %s event(s) in batch", len(accepted))
+            # fanned out in the queue of the events
+            by_queue = defaultdict(list)
+            for data in accepted:
+                by_queue[queue_for(data["event"]).name].append(data)
+            with metrics.enqueue_fanout.time():
+                for name, batch in by_queue.items():
+                    queue(name).enqueue(fanout_many, batch, retry=retry)
+        res = schemas.PublicationResult().dump(results, many=True)
+        return web.json_response(res)
+
+
+@docs(
+    tags=["publish"],
+    summary="Status of a publication",
+    description=(
+        "Spans of the publication and of its fan-out, and the status of the last "
+        "delivery attempt to each subscriber, kept `config.TRACE_TTL` seconds. "
+        "`coalesced` tells a publication held in its coalescing window, or replaced "
+        "by a later one (`replaced_by`) and never delivered."
+    ),
+    responses={
+        200: {"schema": schemas.PublicationStatus(), "description": "Publication status"},
+        404: {"description": "Not found, or expired"},
+    },
+)
+@routes.get(r"/publications/{id:[0-9a-f-]{36}}/")
+async def publication_status(request):
+    status = tracing.get(request.match_info["id"])
+    if not status:
+        raise web.HTTPNotFound()
+    return web.json_response(schemas.PublicationStatus().dump(status))
+
+
+@routes.view("/deliveries/")
+class DeliveriesView(web.View):
+    @docs(
+        tags=["deliveries"],
+        summary="List deliveries",
+        description=(
+            "Deliveries are ordered by id and paginated: the `Link` header "
+            "points to the next page (`after` the last id)."
+        ),
+        responses={
+            200: {
+                "schema": schemas.DeliveryResponse(many=True),
+                "description": "List of deliveries",
+            },
+            304: {"description": "Page not modified (If-None-Match)"},
+        },
+    )
+    @querystring_schema(schemas.DeliveriesQuery())
+    async def get(self):
+        params = self.request["querystring"]
+        deliveries = Delivery.query.order_by(Delivery.id)
+        if "after" in params:
+            deliveries = deliveries.where(Delivery.id > params["after"])
+        if "subscription" in params:
+            deliveries = deliveries.where(Delivery.subscription_id == params["subscription"])
+        if "event" in params:
+            deliveries = deliveries.where(Delivery.event == params["event"])
+        if "since" in params:
+            deliveries = deliveries.where(Delivery.created_at >= params["since"])
+        if "until" in params:
+            deliveries = deliveries.where(Delivery.created_at < params["until"])
+        limit = params.get("limit", config.SUBSCRIPTIONS_PAGE_SIZE)
+        deliveries = await deliveries.limit(limit).gino.all()
+        return page(self.request, deliveries, schemas.DeliveryResponse(), limit)
 
 
 @routes.view("/check/")
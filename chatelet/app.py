@@ -2,6 +2,10 @@ import os
 
 from aiohttp import web
 
+from chatelet import client
+from chatelet import history
+from chatelet import local
+from chatelet import metrics
 from chatelet.api import api_factory
 from chatelet.db import db
 
@@ -12,6 +16,13 @@ async def app_factory():
         "dsn": os.getenv("DATABASE_URL")
     })
     app.add_subapp("/api/", api_factory())
+    app.router.add_get("/metrics", metrics.handler)
+    # jobs run in the app with the local queue backend
+    app.on_startup.append(local.start)
+    app.on_cleanup.append(local.stop)
+    app.on_cleanup.append(client.close)
+    # deliveries are logged from the API process with eager queues
+    app.on_cleanup.append(history.close)
     return app
 
 
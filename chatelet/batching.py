@@ -0,0 +1,39 @@
+"""Accumulation of events for subscriptions in batch mode
+
+Publications ids for a subscription with a `batch_size` are pushed to a
+redis list, shared by all workers (payloads are in `chatelet.payloads`).
+The list is flushed when it holds `batch_size` publications, or `batch_wait`
+seconds after the first one, whichever comes first. Lists expire with the
+payloads they refer to.
+"""
+from chatelet import config
+from chatelet.queue import connection
+
+
+def key(subscription_id):
+    return f"chatelet:batch:{subscription_id}"
+
+
+def push(subscriptions, publication_id):
+    """Add a publication to the batches of `subscriptions`, returns the batches lengths"""
+    with connection().pipeline() as pipe:
+        for sub in subscriptions:
+            pipe.rpush(key(sub.id), publication_id)
+            pipe.expire(key(sub.id), config.PAYLOAD_TTL)
+        return pipe.execute()[::2]
+
+
+def pop(subscription):
+    """Take a batch: `(publication ids, number of publications left)`"""
+    size = subscription.batch_size
+    with connection().pipeline() as pipe:
+        pipe.lrange(key(subscription.id), 0, size - 1)
+        pipe.ltrim(key(subscription.id), size, -1)
+        pipe.llen(key(subscription.id))
+        items, _, left = pipe.execute()
+    return [item.decode() for item in items], left
+
+
+def drop(subscription_id):
+    """Forget the batch of a subscription, eg deactivated"""
+    connection().delete(key(subscription_id))
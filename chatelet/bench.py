@@ -0,0 +1,200 @@
+"""End-to-end load benchmark, run through `python cli.py bench`
+
+Runs the app in process and async workers in subprocesses, against the
+redis and postgres of REDIS_URL and DATABASE_URL (use throwaway ones:
+subscriptions are created, and deleted at the end). Local stub subscribers
+answer with a tunable latency and error rate. Publications are driven at a
+target rate and every delivery is timed from its publication.
+"""
+import asyncio
+import json
+import random
+import resource
+import signal
+import sys
+import time
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from chatelet import config
+from chatelet import events
+from chatelet import filters
+from chatelet import utils
+from chatelet.app import app_factory
+from chatelet.db import Subscription
+
+# a third of subscriptions without filter, a third on an indexed equality, a third on an
+# arbitrary expression (cf `chatelet.index`)
+FILTERS = [None, '$[?(@.kind = "a")]', "$[?(@.size > 50)]"]
+
+
+def percentile(values, p):
+    """`p` percentile (0-100) of `values`, nearest rank"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def check(procs):
+    """Fail early if a worker process exited"""
+    for proc in procs:
+        if proc.returncode is not None:
+            raise RuntimeError(f"Worker {proc.pid} exited with code {proc.returncode}")
+
+
+class StubSubscriber:
+    """A local subscriber, answering after `latency` seconds (+/- 50%), failing `error_rate`"""
+
+    def __init__(self, latency=0.05, error_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        # (path, publication seq) -> delivery latency, of successful deliveries
+        self.received = {}
+        self.errors = 0
+        self.server = None
+
+    async def handle(self, request):
+        body = await request.json()
+        if "intention" in body:
+            return web.Response(headers={"x-hook-secret": request.headers["x-hook-secret"]})
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise web.HTTPInternalServerError()
+        payload = body["payload"]
+        self.received[(request.path, payload["seq"])] = time.time() - payload["sent_at"]
+        return web.json_response({"ok": True})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/{sub}", self.handle)
+        self.server = TestServer(app, host="127.0.0.1")
+        await self.server.start_server()
+        return self
+
+    def url(self, sub):
+        return str(self.server.make_url(f"/{sub}"))
+
+
+async def run(event="test.event.subevent", subscribers=100, stubs=4, rate=50, duration=10,
+              latency=0.05, error_rate=0, workers=1, concurrency=None, drain=60, output=None):
+    secret = (events.get(event) or {}).get("secret")
+    if not secret:
+        raise ValueError(f"{event} is not declared or has no secret")
+    config.ALLOWED_DOMAINS.append("127.0.0.1")
+    config.VALIDATION_OF_INTENT = False
+
+    stub_servers = [await StubSubscriber(latency, error_rate).start() for _ in range(stubs)]
+    app = TestServer(await app_factory(), host="127.0.0.1")
+    await app.start_server()
+    procs = []
+    try:
+        async with ClientSession() as session:
+            subs = []
+            for i in range(subscribers):
+                event_filter = FILTERS[i % len(FILTERS)]
+                stub = stub_servers[i % stubs]
+                resp = await session.post(app.make_url("/api/subscriptions/"), json={
+                    "event": event, "url": stub.url(i), "event_filter": event_filter,
+                })
+                resp.raise_for_status()
+                subs.append((f"/{i}", event_filter))
+
+            for _ in range(workers):
+                # metrics are not needed here, and workers would share a port
+                args = ["work", "--metrics-port=0"]
+                args += [f"--concurrency={concurrency}"] if concurrency else []
+                procs.append(await asyncio.create_subprocess_exec(
+                    sys.executable, "cli.py", *args
+                ))
+
+            publish_times, publish_errors, expected = [], 0, set()
+
+            async def publish(seq):
+                nonlocal publish_errors
+                payload = {
+                    "seq": seq, "kind": random.choice("ab"), "size": random.randint(0, 100),
+                    "sent_at": time.time(),
+                }
+                body = utils.dumps({"event": event, "payload": payload})
+                started = time.monotonic()
+                async with session.post(app.make_url("/api/publications/"), data=body, headers={
+                    "Content-Type": "application/json",
+                    "x-hook-signature": utils.sign(body, secret),
+                }) as resp:
+                    publish_times.append(time.monotonic() - started)
+                    if resp.status != 201:
+                        publish_errors += 1
+                        return
+                for path, event_filter in subs:
+                    if not event_filter or filters.match(event_filter, payload):
+                        expected.add((path, seq))
+
+            started = time.monotonic()
+            tasks, seq = [], 0
+            while time.monotonic() - started < duration:
+                check(procs)
+                tasks.append(asyncio.create_task(publish(seq)))
+                seq += 1
+                await asyncio.sleep(max(0, started + seq / rate - time.monotonic()))
+            await asyncio.gather(*tasks)
+            published_in = time.monotonic() - started
+
+            def delivered():
+                return sum(len(stub.received) for stub in stub_servers)
+
+            while delivered() < len(expected) and time.monotonic() - started < duration + drain:
+                check(procs)
+                await asyncio.sleep(0.2)
+            elapsed = time.monotonic() - started
+    finally:
+        for proc in procs:
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            await proc.wait()
+        await Subscription.delete.where(Subscription.url.like("http://127.0.0.1:%")).gino.status()
+        await app.close()
+        for stub in stub_servers:
+            await stub.server.close()
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    latencies = [t for stub in stub_servers for t in stub.received.values()]
+    report = {
+        "params": {
+            "event": event, "subscribers": subscribers, "stubs": stubs, "rate": rate,
+            "duration": duration, "latency": latency, "error_rate": error_rate,
+            "workers": workers, "concurrency": concurrency or config.WORKER_CONCURRENCY,
+        },
+        "publish": {
+            **summary(publish_times),
+            "errors": publish_errors,
+            "rate": len(publish_times) / published_in,
+        },
+        "delivery": {
+            **summary(latencies),
+            "expected": len(expected),
+            "subscriber_errors": sum(stub.errors for stub in stub_servers),
+        },
+        "throughput": len(latencies) / elapsed,
+        "worker_cpu": {
+            "seconds": usage.ru_utime + usage.ru_stime,
+            "percent": 100 * (usage.ru_utime + usage.ru_stime) / elapsed / workers,
+        },
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
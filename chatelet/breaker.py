@@ -0,0 +1,118 @@
+"""Circuit breakers on deliveries, per subscription and per subscriber host
+
+State lives in redis so that it is shared by every worker. A circuit is:
+- closed: deliveries go through, consecutive failures are counted;
+- open: after `config.BREAKER_THRESHOLD` consecutive failures, deliveries
+  are parked (delayed) until `config.BREAKER_OPEN_SECONDS` have passed;
+- half-open: then a single trial delivery goes through, its success closes
+  the circuit, its failure opens it again.
+A subscription failing `config.BREAKER_DEACTIVATE_AFTER` times in a row is
+deactivated.
+"""
+import time
+
+from chatelet import config
+from chatelet.queue import connection
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+DEACTIVATED = "deactivated"
+
+# forget about failures after a day w/o any
+TTL = 24 * 3600
+
+
+def key(kind, name):
+    return f"chatelet:breaker:{kind}:{name}"
+
+
+def _state(data: dict, now: float) -> str:
+    if data.get(b"deactivated"):
+        return DEACTIVATED
+    opened_until = float(data.get(b"opened_until", 0))
+    if not opened_until:
+        return CLOSED
+    return OPEN if now < opened_until else HALF_OPEN
+
+
+def status(kind, name) -> dict:
+    data = connection().hgetall(key(kind, name))
+    opened_until = float(data.get(b"opened_until", 0))
+    return {
+        "state": _state(data, time.time()),
+        "failures": int(data.get(b"failures", 0)),
+        "opened_until": opened_until or None,
+    }
+
+
+def check(subscription_id, host):
+    """What to do with a delivery: `(state, delay)`
+
+    - `(CLOSED, 0)` or `(HALF_OPEN, 0)` (trial): deliver
+    - `(OPEN, delay)`: park the delivery for `delay` seconds
+    - `(DEACTIVATED, 0)`: drop the delivery
+    """
+    conn = connection()
+    now = time.time()
+    with conn.pipeline() as pipe:
+        pipe.hgetall(key("subscription", subscription_id))
+        pipe.hgetall(key("host", host))
+        circuits = zip(("subscription", "host"), (subscription_id, host), pipe.execute())
+    delay, trials = 0, []
+    for kind, name, data in circuits:
+        state = _state(data, now)
+        if state == DEACTIVATED:
+            return DEACTIVATED, 0
+        if state == OPEN:
+            delay = max(delay, float(data[b"opened_until"]) - now)
+        elif state == HALF_OPEN:
+            trials.append(key(kind, name))
+    if delay:
+        return OPEN, delay
+    acquired = []
+    for trial in trials:
+        # a single trial at a time, others wait for its outcome
+        if not conn.set(f"{trial}:trial", 1, nx=True, ex=config.HTTP_TIMEOUT + 5):
+            if acquired:
+                conn.delete(*acquired)
+            return OPEN, config.HTTP_TIMEOUT
+        acquired.append(f"{trial}:trial")
+    return (HALF_OPEN if trials else CLOSED), 0
+
+
+def success(subscription_id, host):
+    connection().delete(
+        *[key(k, n) + suffix
+          for k, n in (("subscription", subscription_id), ("host", host))
+          for suffix in ("", ":trial")]
+    )
+
+
+def failure(subscription_id, host) -> bool:
+    """Count a failure, returns True if the subscription should be deactivated"""
+    conn = connection()
+    keys = [key("subscription", subscription_id), key("host", host)]
+    with conn.pipeline() as pipe:
+        for k in keys:
+            pipe.hincrby(k, "failures", 1)
+            pipe.expire(k, TTL)
+            pipe.delete(f"{k}:trial")
+        counts = pipe.execute()[::3]
+    opened_until = time.time() + config.BREAKER_OPEN_SECONDS
+    with conn.pipeline() as pipe:
+        for k, failures in zip(keys, counts):
+            if failures >= config.BREAKER_THRESHOLD:
+                pipe.hset(k, "opened_until", opened_until)
+        pipe.execute()
+    return bool(config.BREAKER_DEACTIVATE_AFTER) and counts[0] >= config.BREAKER_DEACTIVATE_AFTER
+
+
+def deactivated(subscription_id):
+    conn = connection()
+    conn.hset(key("subscription", subscription_id), "deactivated", 1)
+    conn.expire(key("subscription", subscription_id), TTL)
+
+
+def reset(subscription_id):
+    connection().delete(key("subscription", subscription_id))
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+from chatelet import config
+
+context = {}
+
+
+def timer(name):
+    """A trace hook noting the time of a request step in the `trace_request_ctx` dict"""
+    async def hook(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx[name] = time.monotonic()
+    return hook
+
+
+def trace_config() -> TraceConfig:
+    trace = TraceConfig()
+    trace.on_request_start.append(timer("start"))
+    # the last chunk of the body
+    trace.on_request_chunk_sent.append(timer("sent"))
+    trace.on_request_end.append(timer("end"))
+    return trace
+
+
+def spans(timings) -> dict:
+    """`send` (connection and request) and `response` (the subscriber's) durations"""
+    if not {"start", "sent", "end"} <= timings.keys():
+        return {}
+    return {
+        "send": timings["sent"] - timings["start"],
+        "response": timings["end"] - timings["sent"],
+    }
+
+
+def session() -> ClientSession:
+    """Get the client session shared by every request of the running loop
+
+    The underlying connector keeps per-host connections open, so consecutive
+    dispatches to the same subscriber skip the TCP/TLS handshake.
+    """
+    loop = asyncio.get_running_loop()
+    if context.get("_loop") is loop and not context["_session"].closed:
+        return context["_session"]
+    connector = TCPConnector(
+        limit=config.HTTP_POOL_SIZE,
+        limit_per_host=config.HTTP_POOL_SIZE_PER_HOST,
+        keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    context["_session"] = ClientSession(
+        connector=connector,
+        raise_for_status=True,
+        timeout=ClientTimeout(total=config.HTTP_TIMEOUT),
+        trace_configs=[trace_config()],
+    )
+    context["_loop"] = loop
+    return context["_session"]
+
+
+async def close(*args):
+    """Close the shared session (usable as an aiohttp cleanup signal)"""
+    context.pop("_loop", None)
+    client = context.pop("_session", None)
+    if client and not client.closed:
+        await client.close()
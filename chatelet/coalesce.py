@@ -0,0 +1,67 @@
+"""Coalescing of bursts of publications, opt-in per event in `events.yml`
+
+An event declaring a `coalesce_key` (a JSONPath into the payload, eg
+`$.resource_id`) is held for `coalesce_window` seconds: publications with
+the same key value within the window replace each other, and only the last
+one is fanned out when the window closes. State lives in redis, so that
+publications received by any API process are coalesced together.
+"""
+import json
+from datetime import timedelta
+
+from chatelet import config
+from chatelet import filters
+from chatelet import tracing
+from chatelet import utils
+from chatelet.log import log
+from chatelet.queue import connection, queue_for, retry
+
+
+def key_value(expression, payload):
+    """The (JSON encoded) value of `expression` in `payload`, None if absent"""
+    for match in filters.compiled(expression).match(payload):
+        return utils.dumps(match.current_value).decode()
+    return None
+
+
+def keys(event_name, value):
+    held = f"chatelet:coalesce:{event_name}:{value}"
+    return held, f"{held}:scheduled"
+
+
+def hold(data, event) -> bool:
+    """Hold a publication in its coalescing window, False if the event is not coalesced"""
+    if not event.get("coalesce_key"):
+        return False
+    value = key_value(event["coalesce_key"], data["payload"])
+    if value is None:
+        return False
+    window = event.get("coalesce_window") or config.COALESCE_WINDOW
+    held, scheduled = keys(data["event"], value)
+    conn = connection()
+    with conn.pipeline() as pipe:
+        pipe.getset(held, utils.dumps(data))
+        # expiring, should a flush get lost
+        pipe.expire(held, window + 3600)
+        replaced, _ = pipe.execute()
+    trace = {data["id"]: {"coalesced": "held"}}
+    if replaced:
+        trace[json.loads(replaced)["id"]] = {"coalesced": "replaced", "replaced_by": data["id"]}
+    tracing.write(trace)
+    if conn.set(scheduled, 1, nx=True, ex=window + 60):
+        queue_for(data["event"]).enqueue_in(timedelta(seconds=window),
+                                            "chatelet.dispatch.fanout_coalesced",
+                                            data["event"], value, retry=retry)
+    else:
+        log.debug("Coalescing %s (%s)", data["event"], value)
+    return True
+
+
+def release(event_name, value):
+    """Pop the last publication held for `value`, closing its window"""
+    held, scheduled = keys(event_name, value)
+    with connection().pipeline() as pipe:
+        pipe.get(held)
+        pipe.delete(held, scheduled)
+        data, _ = pipe.execute()
+    return json.loads(data) if data else None
@@ -1,5 +1,8 @@
 DEBUG = True
 EAGER_QUEUES = False
+EVENTS_FILE = "events.yml"
+# seconds between checks of EVENTS_FILE modification, to reload it
+EVENTS_RELOAD_INTERVAL = 10
 # Allows domains and subdomains
 ALLOWED_DOMAINS = [
     "data.gouv.fr",
@@ -8,8 +11,112 @@ ALLOWED_DOMAINS = [
     # for debugging purposes
     "webhook.site",
 ]
+# outbound limits per domain (and subdomains), shared by all workers through redis:
+# `concurrency` simultaneous deliveries, `rate` deliveries per second (token bucket
+# of `burst` tokens, defaults to `rate`). Limited deliveries are delayed, not failed
+DOMAIN_LIMITS = {
+    # "data.gouv.fr": {"concurrency": 10, "rate": 20, "burst": 40},
+}
 # If set to False, subscriptions are immediately active (dangerous)
 VALIDATION_OF_INTENT = True
 # deactivate immediate validation of intent
 # if VALIDATION_OF_INTENT is True, only delayed validation will be enabled
 VALIDATION_OF_INTENT_IMMEDIATE = True
+# validation of intent jobs have their own queue, always consumed first by workers
+VALIDATION_QUEUE = "validation"
+# subscriptions listing page size, default and max
+SUBSCRIPTIONS_PAGE_SIZE = 100
+SUBSCRIPTIONS_PAGE_MAX = 1000
+# max publications in a single batch publication
+PUBLICATIONS_BATCH_MAX = 1000
+# batched delivery (opt-in per subscription): max events per POST, and max seconds
+# an event waits for its batch, default and max
+BATCH_SIZE_MAX = 1000
+BATCH_WAIT = 10
+BATCH_WAIT_MAX = 300
+# seconds publications of coalesced events are held (`coalesce_key` in events.yml),
+# unless the event declares its `coalesce_window`
+COALESCE_WINDOW = 5
+# keep the active subscriptions of each event in memory (per process),
+# invalidated through a redis pub/sub channel when they change
+ROUTING_CACHE = True
+ROUTING_CHANNEL = "chatelet:subscriptions"
+# max age in seconds of cached routes, bounds staleness if an invalidation is missed
+ROUTING_CACHE_TTL = 60
+# compiled event filters kept in memory
+FILTERS_CACHE_SIZE = 1024
+# transport of publications to the workers: "rq" (a fan-out job per publication) or
+# "streams" (a redis stream per event namespace, read through a consumer group, which
+# allows replays); deliveries and delayed work are rq jobs either way
+BROKER = "rq"
+# streams: entries read at once, ms a read blocks, approximate max entries kept per
+# stream (the replay history), ms before the pending entries of a silent worker are
+# claimed by another one, and deliveries of an entry before it is dropped
+STREAM_READ_COUNT = 100
+STREAM_BLOCK = 5000
+STREAM_MAXLEN = 100000
+STREAM_CLAIM_IDLE = 60000
+STREAM_MAX_DELIVERIES = 4
+# deliveries enqueued per redis round trip when fanning out a publication
+FANOUT_BATCH_SIZE = 500
+# payloads are stored once in redis for all the deliveries of a publication, expiring
+# after PAYLOAD_TTL seconds, and PAYLOAD_CACHE_SIZE of them are kept in each worker
+PAYLOAD_TTL = 24 * 3600
+PAYLOAD_CACHE_SIZE = 256
+# deliveries failed after all their retries are kept DEAD_LETTER_TTL seconds, and
+# redriven at DEAD_LETTER_REDRIVE_RATE deliveries per second per subscription
+DEAD_LETTER_TTL = 7 * 24 * 3600
+DEAD_LETTER_REDRIVE_RATE = 100
+# trace publications (spans of publication, fan-out and delivery, status per subscription)
+# in redis for TRACE_TTL seconds, cf `GET /api/publications/{id}/`
+TRACING = True
+TRACE_TTL = 24 * 3600
+# log publications and deliveries in DB, written by batches of DELIVERY_LOG_BATCH_SIZE rows
+# or every DELIVERY_LOG_FLUSH_INTERVAL seconds, and purged after DELIVERY_LOG_RETENTION_DAYS
+DELIVERY_LOG = True
+DELIVERY_LOG_BATCH_SIZE = 500
+DELIVERY_LOG_FLUSH_INTERVAL = 2
+DELIVERY_LOG_RETENTION_DAYS = 30
+# concurrent jobs run by each async worker (`python cli.py work`), or by the app
+# with the local queue backend
+WORKER_CONCURRENCY = 50
+# partition deliveries by subscription across SHARDS queues (0 to disable), each consumed
+# by a single worker (`python cli.py supervise` runs them) delivering in order per subscription
+SHARDS = 0
+# deliveries a shard worker holds in the line of a subscription, and in all its lines:
+# when either is reached, it stops dequeuing its shard until they go down
+SHARD_LINE_SIZE = 100
+SHARD_BUFFER_SIZE = 1000
+# "redis" (rq queues, run by workers) or "local": in-process queues run by the app itself,
+# for single node deployments, written ahead to LOCAL_QUEUE_FILE (if set) to survive restarts
+QUEUE_BACKEND = "redis"
+LOCAL_QUEUE_FILE = None
+# the write-ahead file is compacted to the jobs left every that many records written
+# (or twice the jobs left, if more)
+LOCAL_QUEUE_COMPACT_EVERY = 10000
+# port of the prometheus metrics of workers (None to disable), the app serves /metrics
+WORKER_METRICS_PORT = 9100
+# outbound HTTP, connections are pooled and kept alive between dispatches
+HTTP_TIMEOUT = 15
+# the timeout of a delivery is LATENCY_TIMEOUT_FACTOR times the subscriber latency,
+# between HTTP_TIMEOUT_MIN and HTTP_TIMEOUT
+HTTP_TIMEOUT_MIN = 2
+LATENCY_TIMEOUT_FACTOR = 4
+HTTP_POOL_SIZE = 100
+HTTP_POOL_SIZE_PER_HOST = 10
+HTTP_KEEPALIVE_TIMEOUT = 30
+# circuit breakers on deliveries, per subscription and per host: BREAKER_THRESHOLD consecutive
+# failures open the circuit and deliveries are parked for BREAKER_OPEN_SECONDS, then a single
+# trial delivery closes it or opens it again
+BREAKER_THRESHOLD = 5
+BREAKER_OPEN_SECONDS = 60
+# deactivate a subscription after this many consecutive failed deliveries (0 to never)
+BREAKER_DEACTIVATE_AFTER = 50
+# subscriber latency, an EWMA giving LATENCY_EWMA_ALPHA weight to the last delivery:
+# subscriptions slower than SLOW_THRESHOLD seconds (after LATENCY_MIN_SAMPLES deliveries)
+# are delivered through SLOW_QUEUE, at most SLOW_QUEUE_CONCURRENCY at once per worker
+LATENCY_EWMA_ALPHA = 0.2
+LATENCY_MIN_SAMPLES = 5
+SLOW_THRESHOLD = 2
+SLOW_QUEUE = "slow"
+SLOW_QUEUE_CONCURRENCY = 10
@@ -13,6 +13,9 @@ class Subscription(db.Model):
     url = db.Column(db.Unicode())
     active = db.Column(db.Boolean(), default=False)
     secret = db.Column(db.Unicode())
+    # batched delivery: up to batch_size events in a POST, sent within batch_wait seconds
+    batch_size = db.Column(db.Integer())
+    batch_wait = db.Column(db.Integer())
 
     # FIXME: unique does not apply constraint
     _idx1 = db.Index(
@@ -20,3 +23,34 @@ class Subscription(db.Model):
         "event", "event_filter", "url",
         unique=True
     )
+
+
+class Publication(db.Model):
+    __tablename__ = "publications"
+
+    id = db.Column(db.Unicode(), primary_key=True)
+    event = db.Column(db.Unicode())
+    # number of subscribers the publication was dispatched to
+    subscribers = db.Column(db.Integer())
+    created_at = db.Column(db.DateTime(timezone=True))
+
+    _idx1 = db.Index("publications_idx_created_at", "created_at")
+
+
+class Delivery(db.Model):
+    __tablename__ = "deliveries"
+
+    id = db.Column(db.BigInteger(), primary_key=True)
+    publication_id = db.Column(db.Unicode())
+    subscription_id = db.Column(db.Integer())
+    event = db.Column(db.Unicode())
+    # HTTP status of the subscriber response, null if none (eg timeout)
+    status = db.Column(db.Integer())
+    error = db.Column(db.Unicode())
+    # seconds
+    duration = db.Column(db.Float())
+    created_at = db.Column(db.DateTime(timezone=True))
+
+    _idx1 = db.Index("deliveries_idx_created_at", "created_at")
+    _idx2 = db.Index("deliveries_idx_subscription_id_created_at", "subscription_id", "created_at")
+    _idx3 = db.Index("deliveries_idx_event_created_at", "event", "created_at")
@@ -0,0 +1,114 @@
+"""Dead letters: deliveries that failed after all their retries
+
+They are kept in redis by subscription, as a sorted set of publication ids
+(by failure time), along with the host and the last error of the
+subscription, and the subscriptions with dead letters are indexed by host.
+Payloads are stored once per publication (cf `chatelet.payloads`), their
+expiration is extended to `config.DEAD_LETTER_TTL`.
+
+A redrive delivers them again, oldest first, by batches of
+`config.DEAD_LETTER_REDRIVE_RATE` enqueued in a single round trip, one
+batch per second, so that a recovered subscriber is not flooded.
+"""
+import time
+from datetime import timedelta
+from urllib.parse import urlparse
+
+from chatelet import config
+from chatelet import dispatch
+from chatelet import payloads
+from chatelet.db import Subscription
+from chatelet.log import log
+from chatelet.queue import connection, enqueue_many, retry
+
+SUBSCRIPTIONS = "chatelet:dead:subscriptions"
+
+
+def key(kind, name):
+    return f"chatelet:dead:{kind}:{name}"
+
+
+async def bury(func_name, args, error: str) -> bool:
+    """Keep a failed job as dead letters if it is a delivery, returns True if so"""
+    if func_name not in dispatch.DELIVERIES:
+        return False
+    subscription_id, publication_ids = dispatch.DELIVERIES[func_name](*args)
+    sub = await Subscription.get(subscription_id)
+    if not sub:
+        return False
+    host = urlparse(sub.url).hostname
+    log.warning("Dead letters: %s publication(s) to %s (%s)",
+                len(publication_ids), sub.url, sub.id)
+    ttl = config.DEAD_LETTER_TTL
+    with connection().pipeline() as pipe:
+        pipe.zadd(key("subscription", sub.id), {pid: time.time() for pid in publication_ids})
+        pipe.expire(key("subscription", sub.id), ttl)
+        pipe.hset(key("info", sub.id), mapping={
+            "host": host, "error": error[-500:], "failed_at": time.time(),
+        })
+        pipe.expire(key("info", sub.id), ttl)
+        pipe.sadd(SUBSCRIPTIONS, sub.id)
+        pipe.sadd(key("host", host), sub.id)
+        for pid in publication_ids:
+            pipe.expire(payloads.key(pid), ttl)
+        pipe.execute()
+    return True
+
+
+def subscriptions(host=None) -> list:
+    """Ids of the subscriptions with dead letters (on `host`)"""
+    ids = connection().smembers(key("host", host) if host else SUBSCRIPTIONS)
+    return sorted(int(sub_id) for sub_id in ids)
+
+
+def summary(subscription_ids) -> list:
+    """Dead letters count, host and last error of each subscription"""
+    conn = connection()
+    with conn.pipeline() as pipe:
+        for sub_id in subscription_ids:
+            pipe.zcard(key("subscription", sub_id))
+            pipe.hgetall(key("info", sub_id))
+        results = pipe.execute()
+    found = []
+    for sub_id, count, info in zip(subscription_ids, results[::2], results[1::2]):
+        if not count:
+            # redriven or expired
+            conn.srem(SUBSCRIPTIONS, sub_id)
+            if info:
+                conn.srem(key("host", info[b"host"].decode()), sub_id)
+            continue
+        found.append({
+            "subscription": sub_id,
+            "count": count,
+            "host": info.get(b"host", b"").decode(),
+            "error": info.get(b"error", b"").decode(),
+            "failed_at": float(info.get(b"failed_at", 0)),
+        })
+    return found
+
+
+def pop(subscription_id, count) -> list:
+    """Take the `count` oldest dead letters of a subscription"""
+    name = key("subscription", subscription_id)
+    with connection().pipeline() as pipe:
+        pipe.zrange(name, 0, count - 1)
+        pipe.zremrangebyrank(name, 0, count - 1)
+        items, _ = pipe.execute()
+    return [item.decode() for item in items]
+
+
+async def redrive(subscription_id) -> int:
+    """Deliver again a batch of dead letters of a subscription, the next batch in a second"""
+    sub = await Subscription.get(subscription_id)
+    if not sub or not sub.active:
+        log.debug("Not redriving to inactive subscription %s", subscription_id)
+        return 0
+    publication_ids = pop(sub.id, config.DEAD_LETTER_REDRIVE_RATE)
+    if not publication_ids:
+        return 0
+    lane = dispatch.lane(sub)
+    enqueue_many(lane, [(dispatch.dispatch, (pid, sub.id)) for pid in publication_ids],
+                 retry=retry)
+    if len(publication_ids) == config.DEAD_LETTER_REDRIVE_RATE:
+        lane.enqueue_in(timedelta(seconds=1), redrive, sub.id)
+    return len(publication_ids)
@@ -0,0 +1,356 @@
+"""Jobs run by the workers: validation of intent, fan-out and delivery"""
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import timedelta
+from urllib.parse import urlparse
+
+from aiohttp import ClientResponseError, ClientTimeout
+from rq import Retry
+
+from chatelet import batching
+from chatelet import breaker
+from chatelet import client
+from chatelet import coalesce
+from chatelet import events
+from chatelet import config
+from chatelet import history
+from chatelet import latency
+from chatelet import limits
+from chatelet import metrics
+from chatelet import payloads
+from chatelet import routing
+from chatelet import tracing
+from chatelet import utils
+from chatelet.db import Subscription
+from chatelet.log import log
+from chatelet.queue import queue, queue_for, retry, enqueue_many, shard
+
+HEADER_SECRET = "x-hook-secret"
+HEADER_SIGNATURE = "x-hook-signature"
+# delivery jobs -> how to get (subscription id, publication ids) from their args
+DELIVERIES = {
+    "chatelet.dispatch.dispatch": lambda pid, sub_id: (sub_id, [pid]),
+    "chatelet.dispatch.dispatch_batch": lambda sub_id, pids: (sub_id, pids),
+}
+# set while a shard worker runs a delivery, in the line of its subscription
+in_line = ContextVar("in_line", default=False)
+# set by the workers running a job, the retries it has left
+retries_left = ContextVar("retries_left", default=None)
+
+
+class Parked(Exception):
+    """A delivery parked in the line of its subscription, to run again in `delay` seconds"""
+
+    def __init__(self, delay):
+        super().__init__(delay)
+        self.delay = delay
+
+
+async def validate_intent(sub):
+    log.debug("Validating intent for %s (%s)", sub.url, sub.id)
+    try:
+        async with client.session().post(sub.url, json={"intention": "pure"}, headers={
+            HEADER_SECRET: sub.secret
+        }) as res:
+            validated = res.ok and res.headers.get('x-hook-secret') == sub.secret
+    except Exception:
+        metrics.validation_error.inc()
+        raise
+    (metrics.validation_ok if validated else metrics.validation_ko).inc()
+    if validated:
+        sub = await Subscription.get(sub.id)
+        await sub.update(active=True).apply()
+        breaker.reset(sub.id)
+        routing.invalidate(sub.event)
+        log.debug("Intent validated for %s (%s)", sub.url, sub.id)
+    else:
+        raise ValueError(f"Intent _not_ validated for {sub.url} ({sub.id})")
+
+
+async def fanout(data):
+    """Enqueue the deliveries of a publication to its subscribers"""
+    await fanout_many([data])
+
+
+async def fanout_many(publications):
+    """Enqueue the deliveries of publications to their subscribers
+
+    Subscribers come from the routing table (cf `chatelet.routing`) and
+    event filters are evaluated here, so that subscribers not matching the
+    payload do not cost a job. Deliveries are enqueued by batches of
+    `config.FANOUT_BATCH_SIZE`, each batch in a single redis round trip.
+    Payloads are stored once (cf `chatelet.payloads`), jobs only carry ids.
+    Events for subscribers in batch mode are accumulated (cf `chatelet.batching`).
+    """
+    started_at, started = time.time(), time.perf_counter()
+    indexes = await routing.matching({data["event"] for data in publications})
+    routed = time.perf_counter() - started
+    # queue name -> deliveries, each event has its queue (cf `events.yml`)
+    deliveries = defaultdict(list)
+    stored, traces = [], {}
+    for data in publications:
+        matched = time.perf_counter()
+        subs_indexes = indexes[data["event"]]
+        matching = by_url(sub for subs_index in subs_indexes
+                          for sub in subs_index.match(data["payload"]))
+        resolve = routed + time.perf_counter() - matched
+        traces[data["id"]] = tracing.fanout_fields(matching, resolve, started_at)
+        log.debug("Fanning out %s to %s subscriber(s), %s filtered out or duplicate",
+                  data["event"], len(matching),
+                  sum(map(len, subs_indexes)) - len(matching))
+        history.record_publication(data["id"], data["event"], len(matching))
+        metrics.subscribers.observe(len(matching))
+        if not matching:
+            continue
+        # serialized once for all deliveries
+        stored.append((data["id"], data["event"], utils.dumps(data["payload"])))
+        # slow subscribers have a lane of their own (cf `chatelet.latency`)
+        slow = latency.slow_many([sub.id for sub in matching])
+        name = queue_for(data["event"]).name
+        batched = [sub for sub in matching if sub.batch_size]
+        for sub in matching:
+            if not sub.batch_size:
+                call = (dispatch, (data["id"], sub.id))
+                deliveries[lane_of(sub, sub.id in slow, name)].append(call)
+        for sub, length in zip(batched, batching.push(batched, data["id"])):
+            lane_name = lane_of(sub, sub.id in slow, name)
+            if length % sub.batch_size == 0:
+                deliveries[lane_name].append((flush_batch, (sub.event, sub.id)))
+            elif length == 1:
+                queue(lane_name).enqueue_in(timedelta(seconds=sub.batch_wait),
+                                            flush_batch, sub.event, sub.id)
+    payloads.store_many(stored)
+    tracing.write(traces)
+    enqueued_at, started = time.time(), time.perf_counter()
+    for name, calls in deliveries.items():
+        for batch in utils.chunks(calls, config.FANOUT_BATCH_SIZE):
+            enqueue_many(queue(name), batch, retry=retry)
+    enqueue = time.perf_counter() - started
+    metrics.enqueue_deliveries.observe(enqueue)
+    tracing.write({pid: {"enqueue": enqueue, "enqueued_at": enqueued_at} for pid in traces})
+
+
+def by_url(subscriptions) -> list:
+    """A single subscription per url, the first one (ie the most specific)"""
+    unique = {}
+    for sub in subscriptions:
+        unique.setdefault(sub.url, sub)
+    return list(unique.values())
+
+
+async def fanout_coalesced(event_name, key_value):
+    """Fan out the last publication held in a coalescing window (cf `chatelet.coalesce`)"""
+    data = coalesce.release(event_name, key_value)
+    if data:
+        await fanout_many([data])
+
+
+async def resolve(event, subscription_id):
+    """The active subscription of id `subscription_id`, from the routing table
+
+    It may be subscribed to `event` or to a pattern matching it.
+    """
+    subscription = None
+    for subs_index in (await routing.matching([event]))[event]:
+        subscription = subs_index.subscriptions.get(subscription_id)
+        if subscription:
+            break
+    if not subscription:
+        log.debug("Dropping %s to inactive subscription %s", event, subscription_id)
+    return subscription
+
+
+async def flush_batch(event, subscription_id):
+    """Enqueue the delivery of the events accumulated for a subscription"""
+    subscription = await resolve(event, subscription_id)
+    if not subscription:
+        # not delivered if it is activated again
+        batching.drop(subscription_id)
+        return
+    publication_ids, left = batching.pop(subscription)
+    if publication_ids:
+        lane(subscription).enqueue(dispatch_batch, subscription.id, publication_ids,
+                                   retry=retry)
+    if left:
+        # the next batch gets its own wait
+        lane(subscription).enqueue_in(timedelta(seconds=subscription.batch_wait),
+                                      flush_batch, event, subscription_id)
+
+
+def envelope(subscription, payload: bytes, key=b"payload", **fields) -> bytes:
+    """The JSON body delivered to `subscription`, around the encoded `payload`
+
+    `fields` are added to the envelope, eg the `event` published to a pattern.
+    """
+    head = utils.dumps({
+        "ok": True,
+        "event": subscription.event,
+        "event_filter": subscription.event_filter,
+        "subscription": subscription.id,
+        **fields,
+    })
+    return head[:-1] + b',"' + key + b'":' + payload + b"}"
+
+
+async def dispatch(publication_id, subscription_id):
+    """Dispatch a publication to a subscription
+
+    The JSON encoded payload (cf `chatelet.payloads`) is spliced as is in the body.
+    """
+    publication = payloads.get(publication_id)
+    if not publication:
+        log.warning("Payload of %s expired, not dispatched to %s",
+                    publication_id, subscription_id)
+        return
+    event, payload = publication
+    subscription = await resolve(event, subscription_id)
+    if subscription:
+        body = envelope(subscription, payload, event=event)
+        await deliver(subscription, body, [publication_id],
+                      (dispatch, publication_id, subscription_id))
+
+
+async def dispatch_batch(subscription_id, publication_ids: list):
+    """Dispatch a batch of publications to a subscription, as a `payloads` array
+
+    The event of each payload is in the `events` array. Retries apply to the whole batch.
+    """
+    found = payloads.get_many(publication_ids)
+    if len(found) < len(publication_ids):
+        log.warning("Payloads of %s publication(s) expired, not dispatched to %s",
+                    len(publication_ids) - len(found), subscription_id)
+    publication_ids = [pid for pid in publication_ids if pid in found]
+    if not publication_ids:
+        return
+    event = found[publication_ids[0]][0]
+    subscription = await resolve(event, subscription_id)
+    if not subscription:
+        return
+    body = b"[" + b",".join(found[pid][1] for pid in publication_ids) + b"]"
+    body = envelope(subscription, body, key=b"payloads",
+                    events=[found[pid][0] for pid in publication_ids])
+    await deliver(subscription, body, publication_ids,
+                  (dispatch_batch, subscription_id, publication_ids))
+
+
+async def deliver(subscription, body: bytes, publication_ids: list, job: tuple):
+    """POST `body` to a subscription
+
+    Uses the client session shared by the process (cf `chatelet.client`),
+    so that connections to a subscriber are reused between dispatches.
+    Deliveries go through circuit breakers (cf `chatelet.breaker`) and
+    per domain limits (cf `chatelet.limits`): while the subscription's or
+    its host's circuit is open, or a limit is hit, `job` (`(func, *args)`)
+    is parked.
+    """
+    host = urlparse(subscription.url).hostname
+    state, delay = breaker.check(subscription.id, host)
+    if state == breaker.DEACTIVATED:
+        log.debug("Dropping %s to deactivated subscription %s",
+                  subscription.event, subscription.id)
+        tracing.delivery(publication_ids, subscription.id, status="dropped")
+        return
+    if state == breaker.OPEN:
+        log.debug("Circuit open for %s (%s), parking %s for %.0fs",
+                  subscription.url, subscription.id, subscription.event, delay)
+        tracing.delivery(publication_ids, subscription.id, status="parked", delay=delay)
+        await park(delay, subscription, *job)
+        return
+    lease, delay = limits.acquire(host, ticket=f"{subscription.id}:{publication_ids[0]}")
+    if delay:
+        log.debug("Rate limited on %s, delaying %s to %s (%s) for %.1fs",
+                  host, subscription.event, subscription.url, subscription.id, delay)
+        tracing.delivery(publication_ids, subscription.id, status="parked", delay=delay)
+        await park(delay, subscription, *job)
+        return
+    sub_latency, _ = latency.get(subscription.id)
+    log.debug("Dispatching %s to %s (%s)",
+              subscription.event, subscription.url, subscription.id)
+    headers = {"Content-Type": "application/json"}
+    if subscription.secret:
+        headers[HEADER_SIGNATURE] = utils.sign(body, subscription.secret)
+    status, error = None, None
+    # filled by the session trace hooks (cf `chatelet.client`)
+    timings = {}
+    started_at, started = time.time(), time.monotonic()
+    try:
+        timeout = ClientTimeout(total=latency.timeout(sub_latency))
+        async with client.session().post(subscription.url, data=body, headers=headers,
+                                         timeout=timeout, trace_request_ctx=timings) as res:
+            status = res.status
+    except Exception as e:
+        if isinstance(e, ClientResponseError):
+            status, error = e.status, e.message
+        else:
+            error = repr(e)
+        if breaker.failure(subscription.id, host):
+            await deactivate(subscription)
+        raise
+    else:
+        breaker.success(subscription.id, host)
+    finally:
+        duration = time.monotonic() - started
+        limits.release(host, lease)
+        latency.record(subscription.id, duration)
+        metrics.dispatch_duration(host, status).observe(duration)
+        for publication_id in publication_ids:
+            history.record_delivery(publication_id, subscription, status, error, duration)
+        tracing.delivery(
+            publication_ids, subscription.id, status="failed" if error else "delivered",
+            code=status, error=error, started_at=started_at, duration=duration,
+            **client.spans(timings),
+        )
+
+
+def lane_of(subscription, slow: bool, event_queue: str) -> str:
+    """Name of the queue of deliveries to `subscription`
+
+    Its shard with `config.SHARDS`, else the slow lane or the queue of the event.
+    """
+    if config.SHARDS:
+        return shard(subscription.id)
+    return config.SLOW_QUEUE if slow else event_queue
+
+
+def lane(subscription):
+    """The queue of deliveries to `subscription`"""
+    _, slow = latency.get(subscription.id)
+    event_queue = queue_for(events.namespace(subscription.event)).name
+    return queue(lane_of(subscription, slow, event_queue))
+
+
+def subscription_of(func_name, args):
+    """The subscription id of a delivery job, None for other jobs"""
+    if func_name in DELIVERIES:
+        return DELIVERIES[func_name](*args)[0]
+
+
+async def park(delay, subscription, func, *args):
+    """Run a delivery again in `delay` seconds, with all its retries
+
+    In a shard worker, the delivery goes back to the head of its subscription's
+    line (cf `chatelet.worker.ShardWorker`), keeping the order of its
+    deliveries, else it is enqueued again.
+    """
+    if in_line.get():
+        raise Parked(delay)
+    lane(subscription).enqueue_in(timedelta(seconds=delay), func, *args, retry=retry_left())
+
+
+def retry_left():
+    """The `Retry` of a job parked again, with the retries the running job has left"""
+    left = retries_left.get()
+    if left is None:
+        return retry
+    return Retry(max=left, interval=retry.intervals) if left else None
+
+
+async def deactivate(subscription):
+    """Deactivate a subscription that ran out of its failure budget"""
+    log.warning("Deactivating %s (%s) after %s consecutive failures",
+                subscription.url, subscription.id, config.BREAKER_DEACTIVATE_AFTER)
+    await Subscription.update.values(active=False)\
+        .where(Subscription.id == subscription.id).gino.status()
+    breaker.deactivated(subscription.id)
+    routing.invalidate(subscription.event)
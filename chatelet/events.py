@@ -1,44 +1,100 @@
-import copy
 import os
 import re
+import time
+from types import MappingProxyType
 
 from yaml import safe_load
 
+from chatelet import config
+from chatelet.log import log
+
 context = {}
 
+# keys of a node holding a setting rather than a child event,
+# settings apply to the events below the node, unless overridden
+SETTINGS = {"secret", "queue", "priority", "coalesce_key", "coalesce_window"}
+DEFAULTS = {
+    "secret": None,
+    "queue": "default",
+    "priority": 1,
+    "coalesce_key": None,
+    "coalesce_window": None,
+}
+
+
+def resolve(value):
+    """Replace `${VAR}` with the value of the VAR env var"""
+    if isinstance(value, str):
+        match = re.match(r"\${(.*)}$", value)
+        if match:
+            return os.getenv(match[1])
+    return value
+
+
+def compile(tree: dict) -> dict:
+    """Flatten the events tree to a `{event name: read-only config}` registry"""
+    registry = {}
+
+    def walk(name, node, inherited):
+        node = node or {}
+        conf = {**inherited, **{k: resolve(v) for k, v in node.items() if k in SETTINGS}}
+        registry[name] = MappingProxyType({"event": name, **conf})
+        for key, child in node.items():
+            if key not in SETTINGS:
+                walk(f"{name}.{key}", child, conf)
+
+    for name, node in tree.items():
+        walk(name, node, DEFAULTS)
+    return registry
+
+
+def load() -> dict:
+    with open(config.EVENTS_FILE) as efile:
+        return compile(safe_load(efile.read())["events"])
+
 
 def get_all() -> dict:
-    if "events" in context:
-        return context["events"]
+    """The events registry, reloaded when the events file changes
 
-    with open("events.yml") as efile:
-        events = safe_load(efile.read())["events"]
+    The file is checked at most every `config.EVENTS_RELOAD_INTERVAL` seconds.
+    A file that does not load, or is missing (eg while being replaced), is
+    logged and the previous registry kept.
+    """
+    now = time.monotonic()
+    if "registry" in context and now < context["checked_at"] + config.EVENTS_RELOAD_INTERVAL:
+        return context["registry"]
+    context["checked_at"] = now
+    try:
+        mtime = os.stat(config.EVENTS_FILE).st_mtime
+    except OSError:
+        if "registry" not in context:
+            raise
+        log.warning("%s not found, keeping previous events", config.EVENTS_FILE)
+        return context["registry"]
+    if "registry" in context and mtime == context["mtime"]:
+        return context["registry"]
+    try:
+        registry = load()
+    except Exception:
+        if "registry" not in context:
+            raise
+        log.exception("Failed to reload %s, keeping previous events", config.EVENTS_FILE)
+        context["mtime"] = mtime
+        return context["registry"]
+    context["mtime"] = mtime
+    # swapped in one assignment, lookups see either the old or the new registry
+    context["registry"] = registry
+    return registry
 
-    # replace secret with values
-    for _, config in events.items():
-        if "secret" in config:
-            match = re.match(r"\${(.*)}$", config["secret"])
-            if match:
-                config["secret"] = os.getenv(match[1])
 
-    context["events"] = events
-    return events
+def namespace(name: str) -> str:
+    """The namespace of a subscription pattern (`ns.*`, `ns.**`), else `name`"""
+    for wildcard in (".**", ".*"):
+        if name.endswith(wildcard):
+            return name[:-len(wildcard)]
+    return name
 
 
 def get(event_name: str) -> dict:
-    """Map `namespace.xxx.yyy` to the config dict equivalent"""
-    events = get_all()
-    splitted = event_name.split(".")
-    conf_dict = copy.deepcopy(events)
-    root = conf_dict.pop(splitted[0], None)
-    if not root:
-        return None
-    _walk = copy.deepcopy(root)
-    for idx, part in enumerate(splitted[1:]):
-        _walk = _walk.pop(part, None)
-        if not _walk and idx != len(splitted[1:]) - 1:
-            return None
-    return {
-        "event": event_name,
-        "secret": root.get("secret", None)
-    }
+    """Map `namespace.xxx.yyy` to its (read-only) config dict, None if not declared"""
+    return get_all().get(event_name)
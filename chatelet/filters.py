@@ -0,0 +1,75 @@
+"""Evaluation of subscriptions event filters (JSONPath expressions)"""
+from collections import Counter
+from functools import lru_cache
+
+from jsonpath2.expressions.operator import EqualBinaryOperatorExpression
+from jsonpath2.nodes.current import CurrentNode
+from jsonpath2.nodes.root import RootNode
+from jsonpath2.nodes.subscript import SubscriptNode
+from jsonpath2.nodes.terminal import TerminalNode
+from jsonpath2.path import Path
+from jsonpath2.subscripts.filter import FilterSubscript
+from jsonpath2.subscripts.objectindex import ObjectIndexSubscript
+
+from chatelet import config
+
+SCALARS = (str, int, float, bool, type(None))
+
+# deliveries skipped because the payload did not match the event filter
+counters = Counter()
+
+
+@lru_cache(maxsize=config.FILTERS_CACHE_SIZE)
+def compiled(event_filter: str) -> Path:
+    """Parse an event filter, parsed filters are kept in a bounded LRU"""
+    return Path.parse_str(event_filter)
+
+
+def match(event_filter: str, payload: dict) -> bool:
+    return any(True for _ in compiled(event_filter).match(payload))
+
+
+def _keys(node):
+    """`@.a.b` -> ("a", "b"), None if not a chain of object keys"""
+    keys = []
+    while isinstance(node, SubscriptNode):
+        if len(node.subscripts) != 1 or not isinstance(node.subscripts[0], ObjectIndexSubscript):
+            return None
+        keys.append(node.subscripts[0].index)
+        node = node.next_node
+    return tuple(keys) if keys and isinstance(node, TerminalNode) else None
+
+
+@lru_cache(maxsize=config.FILTERS_CACHE_SIZE)
+def equality(event_filter: str):
+    """`$[?(@.a.b = "x")]` -> (("a", "b"), "x"), None for any other filter shape"""
+    root = compiled(event_filter).root_node
+    node = root.next_node if isinstance(root, RootNode) else None
+    if not (
+        isinstance(node, SubscriptNode)
+        and isinstance(node.next_node, TerminalNode)
+        and len(node.subscripts) == 1
+        and isinstance(node.subscripts[0], FilterSubscript)
+    ):
+        return None
+    expression = node.subscripts[0].expression
+    if not isinstance(expression, EqualBinaryOperatorExpression):
+        return None
+    operands = (expression.left_node_or_value, expression.right_node_or_value)
+    if isinstance(operands[1], CurrentNode):
+        operands = operands[::-1]
+    current, value = operands
+    if not isinstance(current, CurrentNode) or not isinstance(value, SCALARS):
+        return None
+    keys = _keys(current.next_node)
+    return (keys, value) if keys else None
+
+
+def stats() -> dict:
+    cache = compiled.cache_info()
+    return {
+        "cache_hits": cache.hits,
+        "cache_misses": cache.misses,
+        "cache_size": cache.currsize,
+        "filtered": counters["filtered"],
+    }
@@ -0,0 +1,132 @@
+"""Log of publications and deliveries, in the database
+
+Rows are buffered in memory and written with a single COPY when
+`config.DELIVERY_LOG_BATCH_SIZE` rows are waiting, or at most
+`config.DELIVERY_LOG_FLUSH_INTERVAL` seconds after the first one,
+so that logging a delivery does not cost a database round trip.
+Rows older than `config.DELIVERY_LOG_RETENTION_DAYS` are purged by `purge`.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from chatelet import config
+from chatelet.db import db, Delivery, Publication
+from chatelet.log import log
+from chatelet.queue import connection
+
+PURGE_LOCK = "chatelet:history:purge"
+PURGE_CHUNK_SIZE = 10000
+
+
+class BufferedWriter:
+    """Rows of `model`, written by batches
+
+    With `unique`, rows conflicting with existing ones (eg a publication fanned
+    out again) are skipped: they are copied to a temporary table first.
+    """
+
+    def __init__(self, model, columns, unique=False):
+        self.model = model
+        self.columns = columns
+        self.unique = unique
+        self.rows = []
+        self._timer = None
+        self._flushes = set()
+
+    def add(self, *row):
+        self.rows.append(row)
+        if len(self.rows) >= config.DELIVERY_LOG_BATCH_SIZE:
+            self._schedule()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(config.DELIVERY_LOG_FLUSH_INTERVAL, self._schedule)
+
+    def _schedule(self):
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            async with db.acquire() as conn:
+                if self.unique:
+                    await self.copy_unique(conn.raw_connection, rows)
+                else:
+                    await conn.raw_connection.copy_records_to_table(
+                        self.model.__tablename__, records=rows, columns=self.columns
+                    )
+        except Exception:
+            log.exception("Failed to write %s %s rows", len(rows), self.model.__tablename__)
+
+    async def copy_unique(self, conn, rows):
+        table, columns = self.model.__tablename__, ", ".join(self.columns)
+        async with conn.transaction():
+            await conn.execute(f"CREATE TEMP TABLE copy_{table} (LIKE {table}) ON COMMIT DROP")
+            await conn.copy_records_to_table(f"copy_{table}", records=rows, columns=self.columns)
+            await conn.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} "
+                               f"FROM copy_{table} ON CONFLICT DO NOTHING")
+
+    async def close(self):
+        """Write pending rows, waiting for in-flight flushes"""
+        await asyncio.gather(*self._flushes)
+        await self.flush()
+
+
+publications = BufferedWriter(Publication, ["id", "event", "subscribers", "created_at"],
+                              unique=True)
+deliveries = BufferedWriter(Delivery, [
+    "publication_id", "subscription_id", "event", "status", "error", "duration", "created_at",
+])
+
+
+def record_publication(publication_id, event, subscribers):
+    if config.DELIVERY_LOG:
+        publications.add(publication_id, event, subscribers, datetime.now(timezone.utc))
+
+
+def record_delivery(publication_id, subscription, status, error, duration):
+    if config.DELIVERY_LOG:
+        deliveries.add(
+            publication_id, subscription.id, subscription.event, status, error, duration,
+            datetime.now(timezone.utc),
+        )
+
+
+async def close(*args):
+    """Write pending rows (usable as an aiohttp cleanup signal)"""
+    await publications.close()
+    await deliveries.close()
+
+
+async def purge():
+    """Delete rows older than the retention period, by chunks"""
+    until = datetime.now(timezone.utc) - timedelta(days=config.DELIVERY_LOG_RETENTION_DAYS)
+    count = 0
+    for model in (Delivery, Publication):
+        while True:
+            chunk = db.select([model.id]).where(model.created_at < until)\
+                .limit(PURGE_CHUNK_SIZE)
+            status, _ = await model.delete.where(model.id.in_(chunk)).gino.status()
+            deleted = int(status.split()[-1])
+            count += deleted
+            if deleted < PURGE_CHUNK_SIZE:
+                break
+    log.debug("Purged %s delivery log row(s) older than %s", count, until)
+    return count
+
+
+async def retention():
+    """Run `purge` every hour, in a single process at a time"""
+    while True:
+        if connection().set(PURGE_LOCK, 1, nx=True, ex=3600):
+            try:
+                await purge()
+            except Exception:
+                log.exception("Failed to purge the delivery log")
+        await asyncio.sleep(3600)
@@ -0,0 +1,116 @@
+"""In-memory index of the subscriptions to an event
+
+Most event filters look like `$[?(@.organization = "x")]`: they reduce to
+a path into the payload being equal to a literal. Such subscriptions are
+indexed as path -> value -> subscription ids, so that matching a payload
+against them costs one dict lookup per distinct path. Other filters fall
+back to a JSONPath evaluation, once per distinct filter.
+"""
+from collections import defaultdict
+
+from chatelet import filters
+
+context = {}
+
+MISSING = object()
+
+
+def lookup(payload, path: tuple):
+    """Walk `path` (a tuple of keys) into `payload`, MISSING if not found"""
+    value = payload
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+class SubscriptionIndex:
+
+    def __init__(self):
+        # subscription id -> subscription
+        self.subscriptions = {}
+        # subscription ids w/o event filter
+        self.unfiltered = set()
+        # path -> value -> subscription ids
+        self.equalities = defaultdict(lambda: defaultdict(set))
+        # event filter -> subscription ids, for filters w/o an equality shape
+        self.others = defaultdict(set)
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def add(self, sub):
+        if sub.id in self.subscriptions:
+            self.discard(sub.id)
+        self.subscriptions[sub.id] = sub
+        if not sub.event_filter:
+            self.unfiltered.add(sub.id)
+            return
+        equality = filters.equality(sub.event_filter)
+        if equality:
+            path, value = equality
+            self.equalities[path][value].add(sub.id)
+        else:
+            self.others[sub.event_filter].add(sub.id)
+
+    def discard(self, sub_id):
+        sub = self.subscriptions.pop(sub_id, None)
+        if not sub:
+            return
+        if not sub.event_filter:
+            self.unfiltered.discard(sub_id)
+            return
+        equality = filters.equality(sub.event_filter)
+        if equality:
+            path, value = equality
+            ids = self.equalities[path][value]
+            ids.discard(sub_id)
+            if not ids:
+                del self.equalities[path][value]
+                if not self.equalities[path]:
+                    del self.equalities[path]
+        else:
+            ids = self.others[sub.event_filter]
+            ids.discard(sub_id)
+            if not ids:
+                del self.others[sub.event_filter]
+
+    def sync(self, subscriptions):
+        """Update the index to hold `subscriptions`, touching only what changed"""
+        seen = set()
+        for sub in subscriptions:
+            seen.add(sub.id)
+            known = self.subscriptions.get(sub.id)
+            if known is None or known.event_filter != sub.event_filter:
+                self.add(sub)
+            else:
+                # keep the freshest row (url, secret...)
+                self.subscriptions[sub.id] = sub
+        for sub_id in set(self.subscriptions) - seen:
+            self.discard(sub_id)
+
+    def match(self, payload: dict) -> list:
+        """The subscriptions matching `payload`, sorted by id"""
+        ids = set(self.unfiltered)
+        for path, values in self.equalities.items():
+            value = lookup(payload, path)
+            if value is MISSING:
+                continue
+            try:
+                ids.update(values.get(value, ()))
+            except TypeError:
+                # unhashable value (list, dict), can't equal a literal
+                continue
+        for event_filter, sub_ids in self.others.items():
+            if filters.match(event_filter, payload):
+                ids.update(sub_ids)
+        filters.counters["filtered"] += len(self.subscriptions) - len(ids)
+        return [self.subscriptions[sub_id] for sub_id in sorted(ids)]
+
+
+def get(event: str) -> SubscriptionIndex:
+    """Index of the subscriptions to `event` in this process"""
+    if event not in context:
+        context[event] = SubscriptionIndex()
+    return context[event]
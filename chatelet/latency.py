@@ -0,0 +1,73 @@
+"""Latency of subscribers, tracked in redis as an EWMA per subscription
+
+A subscription whose latency exceeds `config.SLOW_THRESHOLD` is flagged
+slow: its deliveries go through `config.SLOW_QUEUE`, consumed with a
+concurrency budget of its own, until its latency gets below half the
+threshold. The timeout of deliveries follows the latency of the subscriber.
+"""
+from chatelet import config
+from chatelet.queue import connection
+
+
+def key(subscription_id):
+    return f"chatelet:latency:{subscription_id}"
+
+
+def read(subscription_id):
+    """`(latency, samples, slow)` of a subscription as stored, latency is None if unknown"""
+    latency, samples, slow = connection().hmget(
+        key(subscription_id), "latency", "samples", "slow"
+    )
+    return None if latency is None else float(latency), int(samples or 0), slow == b"1"
+
+
+def record(subscription_id, duration):
+    """Account for a delivery taking `duration` seconds, returns `(latency, slow)`
+
+    The latency is read and updated in a transaction, retried if a concurrent
+    delivery updated it meanwhile.
+    """
+    name = key(subscription_id)
+
+    def update(pipe):
+        latency, samples, slow = pipe.hmget(name, "latency", "samples", "slow")
+        samples, slow = int(samples or 0) + 1, slow == b"1"
+        if latency is None:
+            latency = duration
+        else:
+            alpha = config.LATENCY_EWMA_ALPHA
+            latency = max(0, alpha * duration + (1 - alpha) * float(latency))
+        if samples >= config.LATENCY_MIN_SAMPLES:
+            # hysteresis, so that subscribers do not flip from a queue to the other
+            slow = latency > config.SLOW_THRESHOLD / (2 if slow else 1)
+        pipe.multi()
+        pipe.hset(name, mapping={"latency": latency, "samples": samples, "slow": int(slow)})
+        pipe.expire(name, 7 * 24 * 3600)
+        return latency, slow
+
+    return connection().transaction(update, name, value_from_callable=True)
+
+
+def get(subscription_id):
+    """`(latency, slow)` of a subscription, latency is None until enough samples"""
+    latency, samples, slow = read(subscription_id)
+    if samples < config.LATENCY_MIN_SAMPLES:
+        return None, False
+    return latency, slow
+
+
+def slow_many(subscription_ids) -> set:
+    """The slow ones among `subscription_ids`, in a single redis round trip"""
+    with connection().pipeline() as pipe:
+        for sub_id in subscription_ids:
+            pipe.hget(key(sub_id), "slow")
+        flags = pipe.execute()
+    return {sub_id for sub_id, slow in zip(subscription_ids, flags) if slow == b"1"}
+
+
+def timeout(latency):
+    """Timeout of a delivery to a subscriber of `latency`"""
+    if latency is None:
+        return config.HTTP_TIMEOUT
+    return min(config.HTTP_TIMEOUT,
+               max(config.HTTP_TIMEOUT_MIN, latency * config.LATENCY_TIMEOUT_FACTOR))
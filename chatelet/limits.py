@@ -0,0 +1,108 @@
+"""Outbound limits per subscriber domain, cf `config.DOMAIN_LIMITS`
+
+State lives in redis so that limits hold across every worker:
+- concurrency: a sorted set of leases scored by their expiry, so that the
+  lease of a crashed worker does not hold a slot forever;
+- rate: a token bucket refilled at `rate` tokens per second, up to `burst`.
+  Tokens are reserved: a delivery over the limit takes the next token to come
+  and waits for it, so that waiting deliveries come back spread at the rate.
+"""
+import random
+import time
+from uuid import uuid4
+
+from chatelet import config
+from chatelet.queue import connection
+
+# how long to wait for a concurrency slot before trying again, on average
+RETRY_DELAY = 1
+
+
+def key(kind, domain):
+    return f"chatelet:limits:{kind}:{domain}"
+
+
+def domain_limits(host):
+    """The `(domain, limits)` applying to `host`, the most specific domain wins"""
+    domains = [d for d in config.DOMAIN_LIMITS if host == d or host.endswith(f".{d}")]
+    if not domains:
+        return None, None
+    domain = max(domains, key=len)
+    return domain, config.DOMAIN_LIMITS[domain]
+
+
+def take_token(domain, rate, burst=None, ticket=None):
+    """Take a token from the domain's bucket, returns seconds to wait for it if it's ahead
+
+    The bucket goes below zero for tokens reserved ahead. A delivery told to
+    wait, identified by `ticket`, gets its reserved token when it comes back.
+    """
+    burst = burst or rate
+    bucket = key("rate", domain)
+    reserved = key("reserved", f"{domain}:{ticket}")
+    if ticket and connection().delete(reserved):
+        return 0
+
+    def take(pipe):
+        now = time.time()
+        tokens, updated_at = pipe.hmget(bucket, "tokens", "updated_at")
+        tokens = burst if tokens is None else float(tokens)
+        tokens = min(burst, tokens + (now - float(updated_at or now)) * rate) - 1
+        wait = max(0, -tokens / rate)
+        pipe.multi()
+        pipe.hset(bucket, mapping={"tokens": tokens, "updated_at": now})
+        pipe.expire(bucket, int((burst - tokens) / rate) + 1)
+        if wait and ticket:
+            # in case the delivery never comes back
+            pipe.set(reserved, 1, ex=int(wait) + config.HTTP_TIMEOUT)
+        return wait
+
+    return connection().transaction(take, bucket, value_from_callable=True)
+
+
+def acquire_slot(domain, concurrency):
+    """Take one of the domain's concurrency slots, returns its lease or None"""
+    slots = key("concurrency", domain)
+    lease = str(uuid4())
+    now = time.time()
+    with connection().pipeline() as pipe:
+        pipe.zremrangebyscore(slots, "-inf", now)
+        pipe.zadd(slots, {lease: now + config.HTTP_TIMEOUT + 5})
+        pipe.zcard(slots)
+        pipe.expire(slots, config.HTTP_TIMEOUT + 5)
+        taken = pipe.execute()[2]
+    if taken > concurrency:
+        connection().zrem(slots, lease)
+        return None
+    return lease
+
+
+def acquire(host, ticket=None):
+    """Acquire the right to deliver to `host`: `(lease, delay)`
+
+    A positive `delay` means the delivery should wait that long, and come
+    back with the same `ticket` to get the token reserved for it. Otherwise
+    `lease` (None when there's no concurrency limit) must be `release`d once
+    the delivery is done.
+    """
+    domain, limits = domain_limits(host)
+    if not limits:
+        return None, 0
+    lease = None
+    if limits.get("concurrency"):
+        lease = acquire_slot(domain, limits["concurrency"])
+        if not lease:
+            # spread, so that waiting deliveries don't all come back at once
+            return None, RETRY_DELAY * random.uniform(0.5, 1.5)
+    if limits.get("rate"):
+        wait = take_token(domain, limits["rate"], limits.get("burst"), ticket)
+        if wait:
+            release(host, lease)
+            return None, wait
+    return lease, 0
+
+
+def release(host, lease):
+    if lease:
+        domain, _ = domain_limits(host)
+        connection().zrem(key("concurrency", domain), lease)
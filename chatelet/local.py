@@ -0,0 +1,241 @@
+"""In-process job queues (`config.QUEUE_BACKEND = "local"`), for single node deployments
+
+`LocalQueue` has the part of rq's `Queue` interface used here (`enqueue`,
+`enqueue_in`, `count`), so that `chatelet.queue.queue()` returns either.
+Jobs of every queue go to a single `asyncio.Queue`, run by a pool of
+`config.WORKER_CONCURRENCY` tasks in the app process (cf `start`): publishing
+does not wait for the fan-out, and no worker process is needed. Failed jobs
+are retried following their `Retry`, like rq does.
+
+With `config.LOCAL_QUEUE_FILE`, jobs are written ahead to that file (pickled,
+like rq does) and marked done once run: the jobs left, in flight or waiting,
+are enqueued again when the app restarts. The file is compacted to the jobs
+left on startup and every `config.LOCAL_QUEUE_COMPACT_EVERY` records. It is
+flushed, not fsynced: it survives a crash of the process, not of the host.
+"""
+import asyncio
+import os
+import pickle
+import time
+import traceback
+from uuid import uuid4
+
+from rq.utils import import_attribute
+
+from chatelet import config
+from chatelet.log import log
+
+context = {}
+# job id -> job, waiting, scheduled or running
+jobs = {}
+
+
+class LocalQueue:
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def count(self) -> int:
+        """Jobs waiting to run"""
+        return len(self._waiting())
+
+    def age(self) -> float:
+        """Seconds the oldest job waiting has been waiting"""
+        waiting = self._waiting()
+        return time.time() - min(job["ready_at"] for job in waiting) if waiting else 0
+
+    def _waiting(self):
+        now = time.time()
+        return [job for job in jobs.values()
+                if job["queue"] == self.name and not job["started"] and job["ready_at"] <= now]
+
+    def enqueue(self, f, *args, retry=None, **kwargs) -> str:
+        return self.enqueue_at(time.time(), f, *args, retry=retry, **kwargs)
+
+    def enqueue_in(self, time_delta, f, *args, retry=None, **kwargs) -> str:
+        return self.enqueue_at(time.time() + time_delta.total_seconds(), f, *args,
+                               retry=retry, **kwargs)
+
+    def enqueue_at(self, ready_at, f, *args, retry=None, **kwargs) -> str:
+        job = self.create_job(ready_at, f, args, kwargs, retry)
+        put([job])
+        return job["id"]
+
+    def enqueue_many(self, calls, retry=None) -> list:
+        """Enqueue `(func, args)` calls, written ahead at once"""
+        batch = [self.create_job(time.time(), func, args, {}, retry) for func, args in calls]
+        put(batch)
+        return [job["id"] for job in batch]
+
+    def create_job(self, ready_at, f, args, kwargs, retry) -> dict:
+        return {
+            "id": str(uuid4()),
+            "queue": self.name,
+            # by name, as rq does, for the write-ahead file
+            "func": f if isinstance(f, str) else f"{f.__module__}.{f.__qualname__}",
+            "args": args,
+            "kwargs": kwargs,
+            "retries_left": retry.max if retry else 0,
+            "retried": 0,
+            "intervals": retry.intervals if retry else [0],
+            "ready_at": ready_at,
+            "started": False,
+        }
+
+
+def write(*records):
+    wal = context.get("wal")
+    if wal:
+        for record in records:
+            pickle.dump(record, wal)
+        wal.flush()
+        context["written"] += len(records)
+
+
+def put(batch, written=False):
+    """Add jobs, run when their `ready_at` time comes"""
+    if not written:
+        write(*(("put", job) for job in batch))
+    loop = asyncio.get_running_loop()
+    for job in batch:
+        jobs[job["id"]] = job
+        delay = job["ready_at"] - time.time()
+        if delay > 0:
+            loop.call_later(delay, ready, job["id"])
+        else:
+            ready(job["id"])
+
+
+def ready(job_id):
+    if "queue" not in context:
+        context["queue"] = asyncio.Queue()
+    context["queue"].put_nowait(job_id)
+
+
+def done(job_id):
+    jobs.pop(job_id, None)
+    write(("done", job_id))
+    if context.get("wal") and \
+            context["written"] >= max(config.LOCAL_QUEUE_COMPACT_EVERY, 2 * len(jobs)):
+        compact()
+
+
+async def perform(job):
+    # imported here, dispatch needs the queues
+    from chatelet import dispatch
+    job["started"] = True
+    dispatch.retries_left.set(job["retries_left"])
+    try:
+        rv = import_attribute(job["func"])(*job["args"], **job["kwargs"])
+        if asyncio.iscoroutine(rv):
+            await rv
+    except Exception:
+        log.exception("Job %s (%s) failed", job["id"], job["func"])
+        if not job["retries_left"]:
+            await bury(job, traceback.format_exc())
+            done(job["id"])
+            return
+        # same intervals as rq, the last one repeats
+        interval = job["intervals"][min(job["retried"], len(job["intervals"]) - 1)]
+        put([{**job, "retries_left": job["retries_left"] - 1, "retried": job["retried"] + 1,
+              "started": False, "ready_at": time.time() + interval}])
+    else:
+        done(job["id"])
+
+
+async def bury(job, error):
+    # imported here, dead letters need the queues
+    from chatelet import deadletters
+    try:
+        await deadletters.bury(job["func"], job["args"], error)
+    except Exception:
+        log.exception("Failed to keep dead letters of job %s", job["id"])
+
+
+async def work():
+    q = context["queue"]
+    while True:
+        job = jobs.get(await q.get())
+        try:
+            if job:
+                await perform(job)
+        except Exception:
+            # eg the write-ahead file, the task must go on with the next jobs
+            log.exception("Failed to run job %s", job["id"])
+        finally:
+            q.task_done()
+
+
+def recover(path) -> list:
+    """Jobs of the write-ahead file not done, the file compacted to them"""
+    pending = {}
+    if os.path.exists(path):
+        with open(path, "rb") as wal:
+            while True:
+                try:
+                    action, value = pickle.load(wal)
+                except EOFError:
+                    break
+                except Exception:
+                    # the last record may be cut short by a crash
+                    log.warning("Truncated record in %s, ignored", path)
+                    break
+                if action == "put":
+                    pending[value["id"]] = {**value, "started": False}
+                else:
+                    pending.pop(value, None)
+    rewrite(path, pending.values())
+    return list(pending.values())
+
+
+def rewrite(path, pending):
+    with open(f"{path}.tmp", "wb") as wal:
+        for job in pending:
+            pickle.dump(("put", job), wal)
+    os.replace(f"{path}.tmp", path)
+
+
+def compact():
+    """Rewrite the write-ahead file with the jobs left only"""
+    context["wal"].close()
+    rewrite(config.LOCAL_QUEUE_FILE, jobs.values())
+    context["wal"] = open(config.LOCAL_QUEUE_FILE, "ab")
+    context["written"] = len(jobs)
+
+
+async def start(app=None):
+    """Start the pool of job tasks (an aiohttp startup hook), after a recovery
+
+    The delivery log retention runs alongside, as there is no worker.
+    """
+    if config.QUEUE_BACKEND != "local":
+        return
+    context.setdefault("queue", asyncio.Queue())
+    if config.LOCAL_QUEUE_FILE:
+        recovered = recover(config.LOCAL_QUEUE_FILE)
+        context["wal"] = open(config.LOCAL_QUEUE_FILE, "ab")
+        context["written"] = len(recovered)
+        if recovered:
+            log.info("Recovered %s jobs from %s", len(recovered), config.LOCAL_QUEUE_FILE)
+            put(recovered, written=True)
+    context["tasks"] = [asyncio.create_task(work()) for _ in range(config.WORKER_CONCURRENCY)]
+    # imported here, the history needs the queues; purged by the workers otherwise
+    from chatelet import history
+    context["tasks"].append(asyncio.create_task(history.retention()))
+
+
+async def join():
+    """Wait for the jobs ready to run, and those they enqueue, to be done"""
+    await context["queue"].join()
+
+
+async def stop(app=None):
+    """Stop the pool (an aiohttp cleanup hook), jobs left are kept in the write-ahead file"""
+    for task in context.pop("tasks", []):
+        task.cancel()
+    wal = context.pop("wal", None)
+    if wal:
+        wal.close()
+    context.pop("queue", None)
+    jobs.clear()
@@ -0,0 +1,143 @@
+"""Prometheus metrics, served on `/metrics` by the app and on
+`config.WORKER_METRICS_PORT` by workers
+
+Label children are bound once (at import, or on the first delivery to a
+host), so that recording a metric on the hot path is a plain method call.
+Queues depth and age, and filtered out deliveries, are read at scrape time.
+"""
+import time
+from functools import wraps
+
+from aiohttp import web
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Histogram,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from rq.job import Job
+from rq.utils import utcnow
+
+from chatelet import config
+from chatelet import filters
+from chatelet.local import LocalQueue
+from chatelet.log import log
+from chatelet.queue import SHARD_QUEUE, connection, queue, weights
+
+publish_seconds = Histogram(
+    "chatelet_publish_seconds", "Publication requests latency", ["endpoint"],
+)
+publish_single = publish_seconds.labels("single")
+publish_batch = publish_seconds.labels("batch")
+
+subscribers = Histogram(
+    "chatelet_publication_subscribers", "Subscribers a publication is dispatched to",
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, float("inf")),
+)
+
+enqueue_seconds = Histogram("chatelet_enqueue_seconds", "Time to enqueue jobs", ["job"])
+enqueue_fanout = enqueue_seconds.labels("fanout")
+enqueue_deliveries = enqueue_seconds.labels("deliveries")
+
+dispatch_seconds = Histogram(
+    "chatelet_dispatch_seconds", "Deliveries duration", ["host", "status"],
+)
+# status class by `status // 100`, `error` when there's no response
+STATUS_CLASSES = ("error", "1xx", "2xx", "3xx", "4xx", "5xx")
+_dispatch_children = {}
+
+retries = Counter("chatelet_retries_total", "Failed jobs scheduled for a retry")
+
+validations = Counter(
+    "chatelet_intent_validations_total", "Validations of intent", ["outcome"],
+)
+validation_ok = validations.labels("validated")
+validation_ko = validations.labels("rejected")
+validation_error = validations.labels("error")
+
+
+def dispatch_duration(host, status):
+    """The `dispatch_seconds` child of `host` and `status` (None on error)"""
+    children = _dispatch_children.get(host)
+    if children is None:
+        children = [dispatch_seconds.labels(host, c) for c in STATUS_CLASSES]
+        _dispatch_children[host] = children
+    return children[status // 100 if status and status < 600 else 0]
+
+
+def timed(histogram):
+    """Decorate a coroutine function to observe its duration in `histogram`"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class StateCollector:
+    """Metrics read at scrape time: queues depth and age, event filters"""
+
+    def describe(self):
+        # not collected on registration, ie when importing this
+        return []
+
+    def collect(self):
+        depth = GaugeMetricFamily("chatelet_queue_depth", "Jobs waiting", labels=["queue"])
+        age = GaugeMetricFamily(
+            "chatelet_queue_oldest_job_seconds", "Age of the oldest job waiting",
+            labels=["queue"],
+        )
+        shards = [SHARD_QUEUE.format(i) for i in range(config.SHARDS)]
+        for name in [config.VALIDATION_QUEUE, *weights(), config.SLOW_QUEUE, *shards]:
+            try:
+                q = queue(name)
+                depth.add_metric([name], q.count)
+                if isinstance(q, LocalQueue):
+                    age.add_metric([name], q.age())
+                    continue
+                oldest = connection().lindex(q.key, 0)
+                job = oldest and Job.fetch(oldest.decode(), connection=connection())
+                waiting = job and job.enqueued_at and utcnow() - job.enqueued_at
+                age.add_metric([name], waiting.total_seconds() if waiting else 0)
+            except Exception:
+                log.exception("Failed to collect metrics of queue %s", name)
+        yield depth
+        yield age
+        stats = filters.stats()
+        filtered = CounterMetricFamily(
+            "chatelet_filtered", "Deliveries skipped, the payload not matching the event filter",
+        )
+        filtered.add_metric([], stats["filtered"])
+        yield filtered
+        compiled = CounterMetricFamily(
+            "chatelet_filter_cache", "Lookups of compiled event filters", labels=["result"],
+        )
+        compiled.add_metric(["hit"], stats["cache_hits"])
+        compiled.add_metric(["miss"], stats["cache_misses"])
+        yield compiled
+        yield GaugeMetricFamily("chatelet_filter_cache_size", "Compiled event filters cached",
+                                value=stats["cache_size"])
+
+
+REGISTRY.register(StateCollector())
+
+
+async def handler(request):
+    return web.Response(body=generate_latest(REGISTRY),
+                        headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+def serve(port):
+    """Export metrics from a worker on `port`, a port already in use is not fatal"""
+    try:
+        start_http_server(port)
+    except OSError as e:
+        log.warning("Worker metrics not served on port %s: %s", port, e)
@@ -0,0 +1,55 @@
+"""Publications payloads, stored once in redis for all their deliveries
+
+Delivery jobs carry a publication id and a subscription id only: the
+(JSON encoded) payload is stored under the publication id, expiring after
+`config.PAYLOAD_TTL` (long enough for retries and parked deliveries), and
+kept in a small per-process LRU, payloads being immutable.
+"""
+from collections import OrderedDict
+
+from chatelet import config
+from chatelet.queue import connection
+
+# publication id -> (event, payload)
+cache = OrderedDict()
+
+
+def key(publication_id):
+    return f"chatelet:payload:{publication_id}"
+
+
+def _remember(publication_id, publication):
+    cache[publication_id] = publication
+    cache.move_to_end(publication_id)
+    while len(cache) > config.PAYLOAD_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def store_many(publications):
+    """Store `(publication id, event, payload)`s in a single redis round trip"""
+    with connection().pipeline() as pipe:
+        for publication_id, event, payload in publications:
+            pipe.hset(key(publication_id), mapping={"event": event, "payload": payload})
+            pipe.expire(key(publication_id), config.PAYLOAD_TTL)
+            _remember(publication_id, (event, payload))
+        pipe.execute()
+
+
+def get_many(publication_ids) -> dict:
+    """`{publication id: (event, payload)}`, expired publications are missing"""
+    found = {pid: cache[pid] for pid in publication_ids if pid in cache}
+    missing = [pid for pid in publication_ids if pid not in found]
+    if missing:
+        with connection().pipeline() as pipe:
+            for pid in missing:
+                pipe.hmget(key(pid), "event", "payload")
+            for pid, (event, payload) in zip(missing, pipe.execute()):
+                if payload is not None:
+                    found[pid] = (event.decode(), payload)
+                    _remember(pid, found[pid])
+    return found
+
+
+def get(publication_id):
+    """`(event, payload)` of a publication, None if expired"""
+    return get_many([publication_id]).get(publication_id)
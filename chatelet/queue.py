@@ -4,9 +4,14 @@ from rq import Queue, Retry
 from redis import Redis
 
 from chatelet import config
+from chatelet import events
+from chatelet.local import LocalQueue
 
 context = {}
 
+DEFAULT_QUEUE = "default"
+SHARD_QUEUE = "shard:{}"
+
 retry = Retry(max=3, interval=[10, 30, 60])
 
 
@@ -14,8 +19,53 @@ def redis_conn():
     return Redis.from_url(os.getenv("REDIS_URL"))
 
 
-def queue():
-    if "_queue" in context:
-        return context["_queue"]
-    context["_queue"] = Queue(connection=redis_conn(), is_async=not config.EAGER_QUEUES)
-    return context["_queue"]
+def connection():
+    """The redis connection of the process, shared by the queues"""
+    if "_connection" not in context:
+        context["_connection"] = redis_conn()
+    return context["_connection"]
+
+
+def queue(name=DEFAULT_QUEUE):
+    key = f"_queue:{name}"
+    if key in context:
+        return context[key]
+    if config.QUEUE_BACKEND == "local":
+        context[key] = LocalQueue(name)
+    else:
+        context[key] = Queue(name, connection=connection(), is_async=not config.EAGER_QUEUES)
+    return context[key]
+
+
+def queue_for(event_name):
+    """The queue of an event, as declared in `events.yml` (`queue` setting)"""
+    event = events.get(event_name)
+    return queue(event["queue"] if event else DEFAULT_QUEUE)
+
+
+def shard(subscription_id) -> str:
+    """The queue of the deliveries to a subscription, with `config.SHARDS`"""
+    return SHARD_QUEUE.format(subscription_id % config.SHARDS)
+
+
+def weights() -> dict:
+    """`{queue name: weight}` of the dispatch queues, from the `priority` of events"""
+    weights = {DEFAULT_QUEUE: 1}
+    for event in events.get_all().values():
+        weights[event["queue"]] = max(event["priority"], weights.get(event["queue"], 0))
+    return weights
+
+
+def enqueue_many(q, calls, retry=None):
+    """Enqueue `(func, args)` calls on `q` in a single redis round trip"""
+    if isinstance(q, LocalQueue):
+        return q.enqueue_many(calls, retry=retry)
+    with q.connection.pipeline() as pipe:
+        # eager queues run jobs on enqueue, there's nothing to pipeline
+        pipeline = pipe if q.is_async else None
+        jobs = [
+            q.enqueue_job(q.create_job(func, args=args, retry=retry), pipeline=pipeline)
+            for func, args in calls
+        ]
+        pipe.execute()
+    return jobs
@@ -0,0 +1,110 @@
+"""Per-process routing table: the active subscriptions of each event
+
+An event's subscriptions are loaded from the database on first use, then
+kept in memory (cf `chatelet.index`) until they change. Changes are
+broadcast on a redis pub/sub channel, so that every API and worker process
+drops its stale entry. `config.ROUTING_CACHE_TTL` bounds the staleness if
+an invalidation is missed, `config.ROUTING_CACHE` bypasses the table.
+"""
+import time
+from collections import defaultdict
+
+from chatelet import config
+from chatelet import index
+from chatelet.db import Subscription
+from chatelet.log import log
+from chatelet.queue import connection
+
+# event -> monotonic time of the load
+context = {}
+# event -> invalidations count, to detect an invalidation racing a load
+generations = {}
+
+
+def patterns(event: str) -> list:
+    """Subscription events matching the publication of `event`, most specific first
+
+    Walks up the namespace trie, eg `a.b.c`, `a.b.*` (children of `a.b`),
+    `a.b.**` and `a.**` (descendants): the routing table being keyed by
+    subscription event, each node is a single lookup.
+    """
+    parts = event.split(".")
+    found = [event]
+    if len(parts) > 1:
+        found.append(".".join(parts[:-1]) + ".*")
+    found += [".".join(parts[:depth]) + ".**" for depth in range(len(parts) - 1, 0, -1)]
+    return found
+
+
+def fresh(event: str) -> bool:
+    loaded_at = context.get(event)
+    return (
+        config.ROUTING_CACHE
+        and loaded_at is not None
+        and time.monotonic() - loaded_at < config.ROUTING_CACHE_TTL
+    )
+
+
+async def load(*events: str) -> list:
+    subs = Subscription.query\
+        .where(Subscription.event.in_(events))\
+        .where(Subscription.active == True)  # noqa
+    return await subs.gino.all()
+
+
+async def get_many(events) -> dict:
+    """Indexes of the active subscriptions to `events`, `{event: index}`
+
+    Events missing from the table are loaded in a single query.
+    """
+    stale = [event for event in events if not fresh(event)]
+    if stale:
+        generation = {event: generations.get(event, 0) for event in stale}
+        loaded_at = time.monotonic()
+        subs = defaultdict(list)
+        for sub in await load(*stale):
+            subs[sub.event].append(sub)
+        for event in stale:
+            index.get(event).sync(subs[event])
+            if generations.get(event, 0) == generation[event]:
+                context[event] = loaded_at
+    return {event: index.get(event) for event in events}
+
+
+async def get(event: str) -> index.SubscriptionIndex:
+    """Index of the active subscriptions to `event`"""
+    return (await get_many([event]))[event]
+
+
+async def matching(events) -> dict:
+    """Indexes of the subscriptions to each of `events`, exact or by pattern
+
+    `{event: [index, ...]}`, indexes of the most specific patterns first.
+    """
+    keys = {event: patterns(event) for event in events}
+    indexes = await get_many({key for event_keys in keys.values() for key in event_keys})
+    return {event: [indexes[key] for key in event_keys] for event, event_keys in keys.items()}
+
+
+def drop(event: str):
+    generations[event] = generations.get(event, 0) + 1
+    context.pop(event, None)
+
+
+def invalidate(event: str):
+    """Drop `event` routes here and in every other process"""
+    drop(event)
+    connection().publish(config.ROUTING_CHANNEL, event)
+
+
+def handle(message):
+    event = message["data"].decode()
+    log.debug("Routes invalidated for %s", event)
+    drop(event)
+
+
+def listen(conn=None):
+    """Listen to invalidations in a thread, returns the thread (to `.stop()` it)"""
+    pubsub = (conn or connection()).pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{config.ROUTING_CHANNEL: handle})
+    return pubsub.run_in_thread(sleep_time=1, daemon=True)
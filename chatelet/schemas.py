@@ -1,5 +1,9 @@
-from jsonpath2.path import Path as JSONPath
-from marshmallow import Schema, fields, ValidationError
+from datetime import timezone
+
+from marshmallow import Schema, fields, validate, validates_schema, ValidationError
+
+from chatelet import config
+from chatelet import filters
 
 
 class JSONPathField(fields.Str):
@@ -14,7 +18,7 @@ class JSONPathField(fields.Str):
         if value is None:
             return
         try:
-            JSONPath.parse_str(value)
+            filters.compiled(value)
             return value
         except ValueError as error:
             raise ValidationError("Not a valid JSONPath.") from error
@@ -22,8 +26,19 @@ class JSONPathField(fields.Str):
 
 class AddSubscription(Schema):
     url = fields.Url(required=True)
-    event = fields.Str(required=True)
+    event = fields.Str(required=True, description=(
+        "An event, or a pattern: `ns.*` for the events right below `ns`, "
+        "`ns.**` for all the events below `ns`"
+    ))
     event_filter = JSONPathField(default=None, allow_none=True)
+    batch_size = fields.Int(
+        allow_none=True, validate=validate.Range(min=1, max=config.BATCH_SIZE_MAX),
+        description="Deliver events by batches of up to this size (batch mode)",
+    )
+    batch_wait = fields.Int(
+        allow_none=True, validate=validate.Range(min=1, max=config.BATCH_WAIT_MAX),
+        description="Max seconds an event waits for its batch, in batch mode",
+    )
 
 
 class AddSubscriptionResponse(AddSubscription):
@@ -31,17 +46,144 @@ class AddSubscriptionResponse(AddSubscription):
     active = fields.Boolean()
 
 
+class SubscriptionsQuery(Schema):
+    after = fields.Int(description="Cursor, list subscriptions with a greater id")
+    limit = fields.Int(validate=validate.Range(min=1, max=config.SUBSCRIPTIONS_PAGE_MAX))
+    event = fields.Str()
+    active = fields.Boolean()
+    stream = fields.Boolean(description="Stream every subscription as NDJSON (no limit)")
+
+
+class DeliveriesQuery(Schema):
+    after = fields.Int(description="Cursor, list deliveries with a greater id")
+    limit = fields.Int(validate=validate.Range(min=1, max=config.SUBSCRIPTIONS_PAGE_MAX))
+    subscription = fields.Int()
+    event = fields.Str()
+    since = fields.AwareDateTime(default_timezone=timezone.utc)
+    until = fields.AwareDateTime(default_timezone=timezone.utc)
+
+
+class DeliveryResponse(Schema):
+    id = fields.Int()
+    publication_id = fields.Str()
+    subscription_id = fields.Int()
+    event = fields.Str()
+    status = fields.Int(description="HTTP status of the subscriber response")
+    error = fields.Str()
+    duration = fields.Float(description="In seconds")
+    created_at = fields.DateTime()
+
+
+class BreakerResponse(Schema):
+    host = fields.Str()
+    state = fields.Str(description="closed, open, half-open or deactivated")
+    failures = fields.Int(description="Consecutive failed deliveries")
+    opened_until = fields.Float(description="Timestamp of the end of the open state")
+
+
+class BreakersResponse(Schema):
+    subscription = fields.Nested(BreakerResponse)
+    host = fields.Nested(BreakerResponse)
+
+
+class DeadLettersQuery(Schema):
+    subscription = fields.Int()
+    host = fields.Str()
+
+
+class DeadLetterSummary(Schema):
+    subscription = fields.Int()
+    host = fields.Str()
+    count = fields.Int(description="Dead letters of the subscription")
+    error = fields.Str(description="Last error")
+    failed_at = fields.Float(description="Timestamp of the last failure")
+
+
+class HostDeadLetters(Schema):
+    host = fields.Str()
+    count = fields.Int()
+
+
+class DeadLettersResponse(Schema):
+    count = fields.Int()
+    hosts = fields.List(fields.Nested(HostDeadLetters))
+    subscriptions = fields.List(fields.Nested(DeadLetterSummary))
+
+
+class RedriveDeadLetters(Schema):
+    subscription = fields.Int()
+    host = fields.Str()
+
+    @validates_schema
+    def validate_target(self, data, **kwargs):
+        if ("subscription" in data) == ("host" in data):
+            raise ValidationError("Either subscription or host is required.")
+
+
+class RedriveResponse(Schema):
+    subscriptions = fields.List(fields.Int(), description="Subscriptions redriven")
+    count = fields.Int(description="Dead letters redriven")
+    inactive = fields.List(fields.Int(), description="Subscriptions skipped, to activate first")
+
+
 class AddPublication(Schema):
     event = fields.Str(required=True)
     payload = fields.Dict(required=True)
 
 
+class PublicationResult(Schema):
+    id = fields.Str(description="Id of the publication, if created")
+    event = fields.Str()
+    status = fields.Int(description="HTTP status of the item: 201, 401 or 404")
+
+
+class PublicationCreated(Schema):
+    id = fields.Str(description="Id of the publication, cf `GET /api/publications/{id}/`")
+
+
+class DeliveryStatus(Schema):
+    subscription = fields.Int()
+    status = fields.Str(description="queued, batched, parked, dropped, delivered or failed")
+    code = fields.Int(description="HTTP status of the subscriber response")
+    error = fields.Str()
+    delay = fields.Float(description="Seconds a parked delivery waits")
+    started_at = fields.Float(description="Timestamp of the last attempt")
+    queue_wait = fields.Float(description="Seconds between enqueue and the last attempt")
+    send = fields.Float(description="Seconds to connect and send the request")
+    response = fields.Float(description="Seconds the subscriber took to respond")
+    duration = fields.Float(description="Seconds of the last attempt")
+
+
+class PublicationStatus(Schema):
+    id = fields.Str()
+    event = fields.Str()
+    published_at = fields.Float()
+    subscribers = fields.Int(description="Subscribers matched, once fanned out")
+    coalesced = fields.Str(description=(
+        "held: in its coalescing window, fanned out when it closes, "
+        "replaced: by a later publication (`replaced_by`), not delivered"
+    ))
+    replaced_by = fields.Str()
+    spans = fields.Dict(keys=fields.Str(), values=fields.Float(), description=(
+        "Seconds spent in validate, fanout_wait, resolve and enqueue"
+    ))
+    deliveries = fields.List(fields.Nested(DeliveryStatus))
+
+
+class ReplaySubscription(Schema):
+    since = fields.Str(required=True, validate=validate.Regexp(r"^\d+(-\d+)?$"), description=(
+        "Stream offset: an entry id or a unix timestamp in ms"
+    ))
+
+
 class DispatchEvent(Schema):
     """This a dummy schema to document the dispatch payload"""
     ok = fields.Bool()
     subscription = fields.Int()
     event = fields.Str(required=True)
     payload = fields.Dict()
+    payloads = fields.List(fields.Dict(), description="Instead of payload, in batch mode")
+    events = fields.List(fields.Str(), description="Event of each payload, in batch mode")
 
 
 class HookSecretSchema(Schema):
@@ -0,0 +1,223 @@
+"""Redis Streams transport of publications (`config.BROKER = "streams"`)
+
+Publications are appended to a stream per event namespace (the root of
+the event name), which keeps about `config.STREAM_MAXLEN` of them. Workers
+read the streams through a consumer group, by batches, fan the publications
+out (cf `chatelet.dispatch.fanout_many`) and acknowledge them. Entries left
+pending by a crashed worker are claimed by another one after
+`config.STREAM_CLAIM_IDLE` ms. Deliveries, their retries and delayed work
+(parked, batched and coalesced deliveries) are still rq jobs.
+
+Streams being the history of publications, a subscription can be replayed
+from a stream offset after a downtime (cf `replay`).
+"""
+import asyncio
+import json
+import time
+
+from redis.exceptions import ResponseError
+
+from chatelet import config
+from chatelet import dispatch
+from chatelet import events
+from chatelet import filters
+from chatelet import payloads
+from chatelet import routing
+from chatelet import utils
+from chatelet.db import Subscription
+from chatelet.log import log
+from chatelet.queue import connection, enqueue_many, retry
+
+GROUP = "chatelet"
+# seconds to wait before reading again after an error, doubled up to MAX_BACKOFF
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# streams whose consumer group exists, as far as this process knows
+context = {"grouped": set()}
+
+
+def key(namespace):
+    return f"chatelet:stream:{namespace}"
+
+
+def stream_for(event_name):
+    return key(event_name.split(".")[0])
+
+
+def streams() -> list:
+    """The streams of the namespaces declared in `events.yml`"""
+    return sorted({stream_for(name) for name in events.get_all()})
+
+
+def append(publications) -> list:
+    """Append publications to their streams in a single round trip, returns entry ids
+
+    The consumer groups are created first, so that workers started later read them.
+    """
+    create_groups({stream_for(data["event"]) for data in publications})
+    with connection().pipeline() as pipe:
+        for data in publications:
+            pipe.xadd(stream_for(data["event"]), {
+                "id": data["id"],
+                "event": data["event"],
+                "payload": utils.dumps(data["payload"]),
+            }, maxlen=config.STREAM_MAXLEN, approximate=True)
+        return [entry_id.decode() for entry_id in pipe.execute()]
+
+
+def decode(fields):
+    """The publication of a stream entry, None if the entry was trimmed"""
+    if not fields:
+        return None
+    return {
+        "id": fields[b"id"].decode(),
+        "event": fields[b"event"].decode(),
+        "payload": json.loads(fields[b"payload"]),
+    }
+
+
+def next_id(entry_id: str) -> str:
+    """The smallest entry id after `entry_id`, to page through a stream"""
+    ms, _, seq = entry_id.partition("-")
+    return f"{ms}-{int(seq or 0) + 1}"
+
+
+def create_groups(names):
+    """Create the consumer group of `names` streams, if missing
+
+    A new group reads the stream from its start, publications appended
+    before it existed included.
+    """
+    for name in set(names) - context["grouped"]:
+        try:
+            connection().xgroup_create(name, GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        context["grouped"].add(name)
+
+
+def read(consumer, names, block=None) -> list:
+    """New entries for `consumer`, `[(stream, entry id, publication)]`"""
+    response = connection().xreadgroup(GROUP, consumer, {name: ">" for name in names},
+                                       count=config.STREAM_READ_COUNT, block=block)
+    return [
+        (name.decode(), entry_id.decode(), decode(fields))
+        for name, entries in response or []
+        for entry_id, fields in entries
+    ]
+
+
+def claim(consumer, names) -> list:
+    """Take over the entries idle for `config.STREAM_CLAIM_IDLE` ms in other consumers
+
+    Entries delivered `config.STREAM_MAX_DELIVERIES` times are dropped.
+    """
+    conn = connection()
+    claimed = []
+    for name in names:
+        pending = conn.xpending_range(name, GROUP, "-", "+", config.STREAM_READ_COUNT)
+        idle = [p for p in pending if p["time_since_delivered"] >= config.STREAM_CLAIM_IDLE]
+        dropped = [p["message_id"] for p in idle
+                   if p["times_delivered"] >= config.STREAM_MAX_DELIVERIES]
+        if dropped:
+            log.error("Dropping %s entries of %s after %s deliveries",
+                      len(dropped), name, config.STREAM_MAX_DELIVERIES)
+            conn.xack(name, GROUP, *dropped)
+        ids = [p["message_id"] for p in idle if p["message_id"] not in dropped]
+        if ids:
+            log.info("Claiming %s idle entries of %s", len(ids), name)
+            claimed += [
+                (name, entry_id.decode(), decode(fields))
+                for entry_id, fields in conn.xclaim(name, GROUP, consumer,
+                                                    config.STREAM_CLAIM_IDLE, ids)
+                # entries trimmed from the stream meanwhile
+                if entry_id is not None
+            ]
+    return claimed
+
+
+def ack(entries):
+    with connection().pipeline() as pipe:
+        for name, entry_id, _ in entries:
+            pipe.xack(name, GROUP, entry_id)
+        pipe.execute()
+
+
+async def process(entries):
+    """Fan out the publications of `entries`, acknowledged once their deliveries are enqueued
+
+    On failure they are left pending, to be claimed again.
+    """
+    publications = [data for _, _, data in entries if data]
+    try:
+        if publications:
+            await dispatch.fanout_many(publications)
+    except Exception:
+        log.exception("Failed to fan out %s publications", len(publications))
+        return
+    ack(entries)
+
+
+async def work(consumer, burst=False):
+    """Read and fan out publications until cancelled
+
+    Errors (eg redis unavailable) are logged and the streams read again after
+    a backoff. In `burst` mode, return once the streams are drained.
+    """
+    loop = asyncio.get_running_loop()
+    claim_at, backoff = 0, 0
+    while True:
+        try:
+            # namespaces may be added to `events.yml` at runtime
+            names = streams()
+            create_groups(names)
+            entries = []
+            if time.monotonic() >= claim_at:
+                claim_at = time.monotonic() + config.STREAM_CLAIM_IDLE / 1000
+                entries = claim(consumer, names)
+            block = None if burst else config.STREAM_BLOCK
+            entries += await loop.run_in_executor(None, read, consumer, names, block)
+            if entries:
+                await process(entries)
+            elif burst:
+                return
+            backoff = 0
+        except Exception:
+            if burst:
+                raise
+            backoff = min(MAX_BACKOFF, backoff * 2 or BACKOFF)
+            log.exception("Failed to read the streams, again in %ss", backoff)
+            await asyncio.sleep(backoff)
+
+
+async def replay(subscription_id, since: str) -> int:
+    """Deliver again the publications to a subscription from the `since` stream offset
+
+    Offsets are entry ids or unix timestamps in ms. Replayed publications are
+    delivered one by one, subscriptions in batch mode included. Returns their count.
+    """
+    sub = await Subscription.get(subscription_id)
+    if not sub or not sub.active:
+        log.debug("Not replaying to inactive subscription %s", subscription_id)
+        return 0
+    name = stream_for(events.namespace(sub.event))
+    count = 0
+    while True:
+        entries = connection().xrange(name, min=since, count=config.STREAM_READ_COUNT)
+        if not entries:
+            return count
+        stored, calls = [], []
+        for entry_id, fields in entries:
+            data = decode(fields)
+            if sub.event not in routing.patterns(data["event"]):
+                continue
+            if sub.event_filter and not filters.match(sub.event_filter, data["payload"]):
+                continue
+            stored.append((data["id"], data["event"], fields[b"payload"]))
+            calls.append((dispatch.dispatch, (data["id"], sub.id)))
+        payloads.store_many(stored)
+        enqueue_many(dispatch.lane(sub), calls, retry=retry)
+        count += len(calls)
+        since = next_id(entries[-1][0].decode())
@@ -0,0 +1,90 @@
+"""Delivery tracing of publications, for `GET /api/publications/{id}/`
+
+Each publication has a redis hash, expiring after `config.TRACE_TTL`:
+timestamps and spans (in seconds) of its publication and fan-out, and a
+compact JSON status per subscription (`sub:<id>`), overwritten by each
+delivery attempt. A coalesced publication is `held` in its window, or
+`replaced` by a later one and never fanned out. Writes cost one round trip
+per publication (or batch of publications) and per delivery.
+"""
+import json
+import time
+
+from chatelet import config
+from chatelet import utils
+from chatelet.queue import connection
+
+# publication spans, in order: checking the signature, waiting for the fan-out job,
+# matching subscriptions, enqueueing deliveries
+SPANS = ("validate", "fanout_wait", "resolve", "enqueue")
+
+
+def key(publication_id):
+    return f"chatelet:trace:{publication_id}"
+
+
+def write(fields_by_publication):
+    """HSET `{publication id: fields}` in a single round trip"""
+    if not config.TRACING or not fields_by_publication:
+        return
+    with connection().pipeline() as pipe:
+        for publication_id, fields in fields_by_publication.items():
+            pipe.hset(key(publication_id), mapping=fields)
+            pipe.expire(key(publication_id), config.TRACE_TTL)
+        pipe.execute()
+
+
+def published(publications, validate: float):
+    now = time.time()
+    write({data["id"]: {"event": data["event"], "published_at": now, "validate": validate}
+           for data in publications})
+
+
+def fanout_fields(subscriptions, resolve: float, started_at: float) -> dict:
+    """Fields of a publication fanned out to `subscriptions`, to `write`"""
+    fields = {"fanout_at": started_at, "resolve": resolve, "subscribers": len(subscriptions)}
+    for sub in subscriptions:
+        status = "batched" if sub.batch_size else "queued"
+        fields[f"sub:{sub.id}"] = utils.dumps({"status": status})
+    return fields
+
+
+def delivery(publication_ids, subscription_id, **status):
+    """Status of the last attempt of a delivery"""
+    status = utils.dumps(status)
+    write({pid: {f"sub:{subscription_id}": status} for pid in publication_ids})
+
+
+def get(publication_id):
+    """Spans and per subscription statuses of a publication, None if unknown or expired"""
+    fields = {
+        name.decode(): value.decode()
+        for name, value in connection().hgetall(key(publication_id)).items()
+    }
+    if not fields:
+        return None
+    published_at = float(fields["published_at"]) if "published_at" in fields else None
+    fanout_at = float(fields["fanout_at"]) if "fanout_at" in fields else None
+    enqueued_at = float(fields["enqueued_at"]) if "enqueued_at" in fields else None
+    spans = {name: float(fields[name]) for name in SPANS if name in fields}
+    if published_at and fanout_at:
+        spans["fanout_wait"] = fanout_at - published_at
+    deliveries = []
+    for name, value in fields.items():
+        if not name.startswith("sub:"):
+            continue
+        status = {"subscription": int(name[4:]), **json.loads(value)}
+        if "started_at" in status and enqueued_at:
+            status["queue_wait"] = status["started_at"] - enqueued_at
+        deliveries.append(status)
+    deliveries.sort(key=lambda status: status["subscription"])
+    return {
+        "id": publication_id,
+        "event": fields.get("event"),
+        "published_at": published_at,
+        "subscribers": int(fields["subscribers"]) if "subscribers" in fields else None,
+        "coalesced": fields.get("coalesced"),
+        "replaced_by": fields.get("replaced_by"),
+        "spans": spans,
+        "deliveries": deliveries,
+    }
@@ -1,6 +1,11 @@
 import json
 import hmac
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 
 def sign(msg, secret):
     if isinstance(secret, str):
@@ -8,3 +13,37 @@ def sign(msg, secret):
     if isinstance(msg, (dict, tuple, list)):
         msg = json.dumps(msg).encode("utf-8")
     return hmac.new(secret, msg, "sha256").hexdigest()
+
+
+def verify(body: bytes, secret, signature) -> bool:
+    """Check `signature` against the raw request `body`
+
+    Falls back to the signature of the re-encoded body, for publishers
+    signing a `json.dumps` of their message but sending it formatted otherwise.
+    """
+    if not signature:
+        return False
+    if hmac.compare_digest(sign(body, secret), signature):
+        return True
+    try:
+        msg = json.loads(body)
+    except ValueError:
+        return False
+    return hmac.compare_digest(sign(msg, secret), signature)
+
+
+def dumps(obj) -> bytes:
+    """Serialize `obj` to compact JSON, using orjson when installed"""
+    if orjson:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # eg integers over 64 bits
+            pass
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def chunks(lst, size):
+    """Split `lst` in lists of `size` items (at most)"""
+    for idx in range(0, len(lst), size):
+        yield lst[idx:idx + size]
@@ -0,0 +1,410 @@
+"""Asyncio dispatch worker
+
+`rq worker` forks a work horse for every job and runs them one at a time.
+`AsyncWorker` pops jobs from the same queues but runs up to `concurrency`
+of them on a single event loop, sharing one HTTP session (cf `chatelet.client`)
+and one database pool. Job bookkeeping (registries, retries, failures) is
+still rq's, so both workers can consume the same queues.
+
+Queues are consumed with weighted fairness (smooth weighted round robin):
+each queue comes first in proportion to its weight, so that a busy queue
+does not starve the others. Queues listed in `first` (validation of intent)
+are always consumed before the others. Queues with a `budgets` entry (the
+slow lane) are not dequeued while that many of their jobs are running.
+
+With `config.SHARDS`, deliveries are partitioned by subscription across
+shard queues, each consumed by a single `ShardWorker` (`supervise` runs
+them): deliveries to a subscription wait in its line and run one at a time,
+in order, retried or parked at the head of the line, while deliveries to
+other subscriptions run concurrently. That order is the order of the fan-out:
+fan-out jobs run concurrently, in every worker, so publications fanned out by
+different jobs may reach a shard in another order than they were published.
+Lines are capped (cf `config.SHARD_LINE_SIZE`), and the deliveries waiting
+in them are kept in rq's started registry: those of a dead worker end up in
+the failed registry.
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+import traceback
+from collections import deque
+from functools import partial
+
+from rq import Worker
+from rq.exceptions import DequeueTimeout
+from rq.job import JobStatus
+from rq.logutils import setup_loghandlers
+from rq.scheduler import RQScheduler
+from rq.utils import utcnow
+from rq.worker import WorkerStatus
+
+from chatelet import client
+from chatelet import config
+from chatelet import deadletters
+from chatelet import dispatch
+from chatelet import history
+from chatelet import metrics
+from chatelet import routing
+from chatelet import streams
+from chatelet.db import db
+from chatelet.log import log
+from chatelet.queue import SHARD_QUEUE, connection, queue, weights as queue_weights
+
+# how long a dequeue blocks, ie how fast a stop request is honoured when idle
+DEQUEUE_TIMEOUT = 5
+
+
+class AsyncWorker(Worker):
+
+    def __init__(self, *args, concurrency=None, weights=None, first=(), budgets=None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency or config.WORKER_CONCURRENCY
+        self.weights = {q.name: (weights or {}).get(q.name, 1) for q in self.queues}
+        self.first = [q for q in self.queues if q.name in first]
+        self.budgets = budgets or {}
+        self._credits = dict.fromkeys(self.weights, 0)
+        self._running = dict.fromkeys(self.weights, 0)
+        self._tasks = set()
+
+    def available(self, queue):
+        return self._running[queue.name] < self.budgets.get(queue.name, self.concurrency)
+
+    def reorder_queues(self, reference_queue=None):
+        """Order queues for the next dequeue, by weighted round robin"""
+        weighted = [q for q in self.queues if q not in self.first and self.available(q)]
+        for q in weighted:
+            self._credits[q.name] += self.weights[q.name]
+        # the queue with the most credits comes first and pays for it
+        weighted.sort(key=lambda q: self._credits[q.name], reverse=True)
+        if weighted:
+            self._credits[weighted[0].name] -= sum(self.weights[q.name] for q in weighted)
+        self._ordered_queues = [q for q in self.first if self.available(q)] + weighted
+
+    def request_stop(self, signum=None, frame=None):
+        """Stop dequeuing, in-flight jobs are left to finish"""
+        self.log.info("Worker %s: warm shut down requested", self.key)
+        self._stop_requested = True
+
+    def dequeue(self, timeout):
+        """Pop the next (job, queue), or None when queues stay empty for `timeout`
+
+        Returns False when no queue is available (cf `available`).
+        """
+        self.heartbeat()
+        if self.should_run_maintenance_tasks:
+            self.run_maintenance_tasks()
+        self.reorder_queues()
+        if not self._ordered_queues:
+            # every queue is over budget, wait for jobs to finish
+            time.sleep(min(timeout or 1, 1))
+            return False
+        try:
+            return self.queue_class.dequeue_any(self._ordered_queues, timeout,
+                                                connection=self.connection,
+                                                job_class=self.job_class,
+                                                serializer=self.serializer)
+        except DequeueTimeout:
+            return None
+
+    async def execute(self, job):
+        job._status = JobStatus.STARTED
+        dispatch.retries_left.set(job.retries_left)
+        rv = job.func(*job.args, **job.kwargs)
+        if asyncio.iscoroutine(rv):
+            rv = await rv
+        return rv
+
+    async def perform_job_async(self, job, queue):
+        """Async counterpart of `Worker.perform_job`"""
+        started_job_registry = queue.started_job_registry
+        try:
+            self.prepare_job_execution(job)
+            job.started_at = utcnow()
+            timeout = job.timeout or self.queue_class.DEFAULT_TIMEOUT
+            rv = await asyncio.wait_for(self.execute(job), timeout if timeout > 0 else None)
+            job.ended_at = utcnow()
+            job._result = rv
+            self.handle_job_success(job=job, queue=queue,
+                                    started_job_registry=started_job_registry)
+        except dispatch.Parked:
+            # still started, run again by its shard worker
+            raise
+        except Exception:
+            job.ended_at = utcnow()
+            exc_info = sys.exc_info()
+            exc_string = "".join(traceback.format_exception(*exc_info))
+            buried = False
+            if job.retries_left:
+                metrics.retries.inc()
+            else:
+                buried = await self.bury(job, exc_string)
+            self.handle_job_failure(job=job, exc_string=exc_string, queue=queue,
+                                    started_job_registry=started_job_registry)
+            if buried:
+                # the dead letter replaces the failed job
+                queue.failed_job_registry.remove(job, delete_job=True)
+            self.handle_exception(job, *exc_info)
+            return False
+        self.log.info("%s: Job OK (%s)", job.origin, job.id)
+        return True
+
+    async def bury(self, job, exc_string):
+        try:
+            return await deadletters.bury(job.func_name, job.args, exc_string)
+        except Exception:
+            self.log.exception("Failed to keep dead letters of job %s", job.id)
+            return False
+
+    def start_scheduler(self, burst):
+        self.scheduler = RQScheduler(self.queues, connection=self.connection)
+        self.scheduler.acquire_locks()
+        if self.scheduler.acquired_locks:
+            if burst:
+                self.scheduler.enqueue_scheduled_jobs()
+                self.scheduler.release_locks()
+            else:
+                self.scheduler.start()
+
+    def _done(self, queue_name, slots, task):
+        self._running[queue_name] -= 1
+        slots.release()
+
+    def submit(self, job, queue, slots):
+        """Perform a dequeued job, holding one of the `slots`"""
+        self.start(self.perform_job_async(job, queue), queue.name, slots)
+
+    def start(self, coro, queue_name, slots):
+        """Run `coro` in a task, which releases its slot when done"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        self._running[queue_name] += 1
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(partial(self._done, queue_name, slots))
+
+    async def work_async(self, burst=False, with_scheduler=True):
+        """Pop and perform jobs concurrently until stopped
+
+        In `burst` mode, return once the queues are empty and every job is done.
+        """
+        loop = asyncio.get_running_loop()
+        self.register_birth()
+        self.log.info("Worker %s: started, concurrency %s", self.key, self.concurrency)
+        self.subscribe()
+        self.set_state(WorkerStatus.STARTED)
+        if with_scheduler:
+            self.start_scheduler(burst)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.request_stop)
+
+        slots = asyncio.Semaphore(self.concurrency)
+        timeout = None if burst else DEQUEUE_TIMEOUT
+        try:
+            while not self._stop_requested:
+                await slots.acquire()
+                result = await loop.run_in_executor(None, self.dequeue, timeout)
+                if not result:
+                    slots.release()
+                    if burst and result is None:
+                        if not self._tasks:
+                            break
+                        await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                self.submit(*result, slots)
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            if self.scheduler:
+                self.stop_scheduler()
+            self.register_death()
+            self.unsubscribe()
+
+
+class ShardWorker(AsyncWorker):
+    """An `AsyncWorker` running the deliveries to a subscription in order
+
+    Deliveries wait in the line of their subscription, and only the one at
+    its head takes a concurrency slot. Failed deliveries are retried (after
+    rq's interval) and parked ones run again (cf `dispatch.park`) at the head
+    of the line, without holding a slot meanwhile.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # subscription id -> its deliveries, `(job, queue)`, the running one first
+        self._lines = {}
+        self._retrying = set()
+        # deliveries in every line, and the full lines, read by `available` in the
+        # dequeue thread
+        self._buffered = 0
+        self._full = set()
+
+    def available(self, queue):
+        if queue.name.startswith(SHARD_QUEUE.format("")):
+            if self._full or self._buffered >= config.SHARD_BUFFER_SIZE:
+                return False
+        return super().available(queue)
+
+    def job_timeout(self, job):
+        return job.timeout or self.queue_class.DEFAULT_TIMEOUT
+
+    def keep_started(self, entries, wait=0):
+        """Keep `(job, queue)` entries in the started registry for `wait` seconds and
+        their timeout, in a single round trip"""
+        with self.connection.pipeline() as pipe:
+            for job, q in entries:
+                ttl = -1 if -1 in (wait, self.job_timeout(job)) else wait + self.job_timeout(job)
+                q.started_job_registry.add(job, ttl, pipeline=pipe)
+            pipe.execute()
+
+    def handle_job_failure(self, job, queue, started_job_registry=None, exc_string=""):
+        if job.retries_left and dispatch.subscription_of(job.func_name, job.args):
+            self._retrying.add(job.id)
+            return
+        super().handle_job_failure(job, queue, started_job_registry=started_job_registry,
+                                   exc_string=exc_string)
+
+    async def execute(self, job):
+        dispatch.in_line.set(True)
+        return await super().execute(job)
+
+    def submit(self, job, queue, slots):
+        line = dispatch.subscription_of(job.func_name, job.args)
+        if line is None:
+            return super().submit(job, queue, slots)
+        self._buffered += 1
+        if line in self._lines:
+            self._lines[line].append((job, queue))
+            if len(self._lines[line]) >= config.SHARD_LINE_SIZE:
+                self._full.add(line)
+            # until it runs, after the running one
+            self.keep_started([(job, queue)], self.job_timeout(self._lines[line][0][0]))
+            slots.release()
+            return
+        self._lines[line] = deque([(job, queue)])
+        self.start(self.perform_line(line, slots), queue.name, slots)
+
+    async def perform_line(self, line, slots):
+        """Perform the deliveries of a line until it is empty, holding a slot when running"""
+        jobs = self._lines[line]
+        queue_name = jobs[0][1].name
+        while True:
+            job, queue = jobs[0]
+            if len(jobs) > 1:
+                self.keep_started(list(jobs)[1:], self.job_timeout(job))
+            delay = None
+            try:
+                await self.perform_job_async(job, queue)
+            except dispatch.Parked as parked:
+                delay = parked.delay
+            if job.id in self._retrying:
+                self._retrying.discard(job.id)
+                delay = job.get_retry_interval()
+                job.retries_left -= 1
+            if delay is None:
+                jobs.popleft()
+                self._buffered -= 1
+                if len(jobs) < config.SHARD_LINE_SIZE:
+                    self._full.discard(line)
+                if not jobs:
+                    del self._lines[line]
+                    return
+            else:
+                self.keep_started(jobs, delay)
+            # let the other lines run meanwhile
+            self._done(queue_name, slots, None)
+            if delay:
+                await asyncio.sleep(delay)
+            await slots.acquire()
+            self._running[queue_name] += 1
+
+
+async def run(burst=False, concurrency=None, shard=None, metrics_port=None):
+    """Run an `AsyncWorker` on the dispatch queues, with its own database bind
+
+    Queues are the validation queue, the queues of the events declared
+    at startup, weighted by their priority (cf `events.yml`), and the slow lane.
+    With the streams broker, publications are read from the streams alongside.
+    A `shard` worker consumes its shard queue instead of the slow lane.
+    Metrics are served on `metrics_port` (0 to disable), by default on
+    `config.WORKER_METRICS_PORT`, or the next ports for shard workers.
+    """
+    setup_loghandlers("DEBUG" if config.DEBUG else "INFO")
+    await db.set_bind(os.getenv("DATABASE_URL"))
+    if metrics_port is None and config.WORKER_METRICS_PORT:
+        metrics_port = config.WORKER_METRICS_PORT + (shard or 0)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    routes_listener = routing.listen()
+    retention = asyncio.create_task(history.retention())
+    consumer = None
+    try:
+        weights = queue_weights()
+        queues = [queue(config.VALIDATION_QUEUE)] + [queue(name) for name in weights]
+        if shard is None:
+            queues.append(queue(config.SLOW_QUEUE))
+            worker_class = AsyncWorker
+        else:
+            # deliveries weigh as much as the busiest namespace
+            weights[SHARD_QUEUE.format(shard)] = max(weights.values())
+            queues.append(queue(SHARD_QUEUE.format(shard)))
+            worker_class = ShardWorker
+        worker = worker_class(queues, connection=connection(), concurrency=concurrency,
+                              weights=weights, first=[config.VALIDATION_QUEUE],
+                              budgets={config.SLOW_QUEUE: config.SLOW_QUEUE_CONCURRENCY})
+        if config.BROKER == "streams":
+            if burst:
+                await streams.work(worker.name, burst=True)
+            else:
+                consumer = asyncio.create_task(streams.work(worker.name))
+        await worker.work_async(burst=burst)
+    finally:
+        if consumer:
+            consumer.cancel()
+        retention.cancel()
+        routes_listener.stop()
+        await history.close()
+        await client.close()
+        await db.pop_bind().close()
+
+
+def supervise(concurrency=None):
+    """Run a shard worker process per `config.SHARDS`, restarted when it dies
+
+    Processes are pinned to the CPU cores in turn, where supported.
+    """
+    if not config.SHARDS:
+        raise ValueError("config.SHARDS is not set")
+    args = ["--concurrency", str(concurrency)] if concurrency else []
+    procs, stopping = {}, []
+
+    def spawn(shard):
+        proc = subprocess.Popen([sys.executable, "cli.py", "work", "--shard", str(shard), *args])
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(proc.pid, {shard % os.cpu_count()})
+        procs[shard] = proc
+        log.info("Shard %s: worker started (%s)", shard, proc.pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for proc in procs.values():
+            proc.send_signal(signal.SIGTERM)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, stop)
+    for shard in range(config.SHARDS):
+        spawn(shard)
+    while procs:
+        time.sleep(1)
+        for shard, proc in list(procs.items()):
+            if proc.poll() is None:
+                continue
+            del procs[shard]
+            if not stopping:
+                log.warning("Shard %s: worker exited (%s), restarting", shard, proc.returncode)
+                spawn(shard)
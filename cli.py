@@ -1,6 +1,10 @@
+import json
+
 from aiohttp.test_utils import TestClient, TestServer
 from minicli import cli, run
 
+from chatelet import bench as benchmark
+from chatelet import worker
 from chatelet.app import app_factory
 
 
@@ -15,6 +19,52 @@ async def apidoc():
             f.write(await resp.text())
 
 
+@cli
+async def work(burst=False, concurrency: int = 0, shard: int = -1, metrics_port: int = -1):
+    """Run the asyncio dispatch worker (replaces `rq worker`)
+
+    :burst: quit once the queues are empty
+    :concurrency: max jobs run at once, defaults to config.WORKER_CONCURRENCY
+    :shard: deliver the subscriptions of this shard, in order (cf config.SHARDS)
+    :metrics_port: port of the metrics, 0 to disable, defaults to config.WORKER_METRICS_PORT
+    """
+    await worker.run(burst=burst, concurrency=concurrency or None,
+                     shard=shard if shard >= 0 else None,
+                     metrics_port=metrics_port if metrics_port >= 0 else None)
+
+
+@cli
+def supervise(concurrency: int = 0):
+    """Run a worker per shard (config.SHARDS), across the CPU cores
+
+    :concurrency: max jobs run at once per worker, defaults to config.WORKER_CONCURRENCY
+    """
+    worker.supervise(concurrency=concurrency or None)
+
+
+@cli
+async def bench(subscribers: int = 100, stubs: int = 4, rate: float = 50, duration: float = 10,
+                latency: float = 0.05, error_rate: float = 0, workers: int = 1,
+                concurrency: int = 0, output="bench.json"):
+    """Benchmark publication and delivery end to end, on throwaway redis and DB
+
+    :subscribers: subscriptions to create, with mixed event filters
+    :stubs: local stub subscriber servers
+    :rate: publications per second
+    :duration: seconds of publication
+    :latency: mean response time of stub subscribers, in seconds
+    :error_rate: ratio of stub subscriber responses in error
+    :workers: worker processes
+    :concurrency: jobs run at once per worker
+    :output: JSON report path
+    """
+    report = await benchmark.run(
+        subscribers=subscribers, stubs=stubs, rate=rate, duration=duration, latency=latency,
+        error_rate=error_rate, workers=workers, concurrency=concurrency or None, output=output,
+    )
+    print(json.dumps(report, indent=2))
+
+
 @cli
 def create_subscriber(event, url):
     pass
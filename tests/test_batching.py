@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from yarl import URL
+
+from chatelet import batching
+from chatelet import routing
+from chatelet import utils
+from chatelet.db import Subscription
+from chatelet.dispatch import flush_batch
+from chatelet.queue import queue
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_add_subscription_batch(client, subscription):
+    resp = await subscription(batch_size=0)
+    assert resp.status == 422
+    resp = await subscription(batch_size=10)
+    assert resp.status == 201
+    data = await resp.json()
+    assert data["batch_size"] == 10
+    assert data["batch_wait"] == 10
+
+
+async def test_batch_delivery(rmock, subscription, publication):
+    """Events are delivered by batches, on size or after the max wait"""
+    await subscription(batch_size=3, batch_wait=60)
+    await subscription(url="http://example.com/single")
+    rmock.post("http://example.com", repeat=True)
+    rmock.post("http://example.com/single", repeat=True)
+    for i in range(4):
+        await publication(payload={"i": i})
+
+    assert len(rmock.requests[("POST", URL("http://example.com/single"))]) == 4
+    r = rmock.requests[("POST", URL("http://example.com"))]
+    assert len(r) == 1
+    body = json.loads(r[0].kwargs["data"])
+    assert body["payloads"] == [{"i": 0}, {"i": 1}, {"i": 2}]
+    assert body["subscription"] == 1
+    sub = await Subscription.get(1)
+    assert r[0].kwargs["headers"]["x-hook-signature"] == utils.sign(
+        r[0].kwargs["data"], sub.secret
+    )
+    # a flush on wait was scheduled for the first and the fourth event
+    assert queue().scheduled_job_registry.count == 2
+
+    await flush_batch(sub.event, sub.id)
+    assert len(r) == 2
+    assert json.loads(r[1].kwargs["data"])["payloads"] == [{"i": 3}]
+    # nothing left
+    await flush_batch(sub.event, sub.id)
+    assert len(r) == 2
+
+
+async def test_batch_inactive(rmock, subscription, publication):
+    """The batch of a subscription no longer active is dropped, batches expire"""
+    await subscription(batch_size=3, batch_wait=60)
+    await publication(payload={"i": 0})
+    conn = queue().connection
+    assert 0 < conn.ttl(batching.key(1)) <= 24 * 3600
+
+    await Subscription.update.values(active=False).where(Subscription.id == 1).gino.status()
+    routing.invalidate("test.event.subevent")
+    await flush_batch("test.event.subevent", 1)
+    assert not conn.exists(batching.key(1))
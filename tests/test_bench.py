@@ -0,0 +1,32 @@
+import time
+
+import pytest
+
+from aiohttp import ClientSession
+
+from chatelet import bench
+
+pytestmark = pytest.mark.asyncio
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert bench.percentile(values, 50) == 50
+    assert bench.percentile(values, 99) == 99
+    assert bench.percentile([3], 99) == 3
+    assert bench.percentile([], 50) is None
+
+
+async def test_stub_subscriber():
+    stub = await bench.StubSubscriber(latency=0).start()
+    try:
+        async with ClientSession() as session:
+            async with session.post(stub.url(1), json={"intention": "pure"},
+                                    headers={"x-hook-secret": "s"}) as resp:
+                assert resp.headers["x-hook-secret"] == "s"
+            payload = {"seq": 7, "sent_at": time.time()}
+            async with session.post(stub.url(1), json={"payload": payload}) as resp:
+                assert resp.status == 200
+        assert list(stub.received) == [("/1", 7)]
+    finally:
+        await stub.server.close()
@@ -0,0 +1,86 @@
+import pytest
+
+from aiohttp import ClientResponseError
+from yarl import URL
+
+from chatelet import breaker
+from chatelet import payloads
+from chatelet.dispatch import dispatch
+from chatelet.db import Subscription
+from chatelet.queue import queue
+
+pytestmark = pytest.mark.asyncio
+
+URL_ = URL("http://example.com")
+
+
+@pytest.fixture
+def breaker_config(mocker):
+    mocker.patch("chatelet.config.BREAKER_THRESHOLD", 2)
+    mocker.patch("chatelet.config.BREAKER_DEACTIVATE_AFTER", 3)
+
+
+def half_open(kind, name):
+    queue().connection.hset(breaker.key(kind, name), "opened_until", 1)
+
+
+async def test_breaker_opens_and_deactivates(client, rmock, subscription, breaker_config):
+    """Failures open the circuit, parking deliveries, then deactivate the subscription"""
+    await subscription()
+    sub = await Subscription.get(1)
+    payloads.store_many([("p", "test.event.subevent", b"{}")])
+    rmock.post("http://example.com", status=500, repeat=True)
+    for _ in range(2):
+        with pytest.raises(ClientResponseError):
+            await dispatch("p", sub.id)
+
+    resp = await client.get("/api/subscriptions/1/breaker/")
+    data = await resp.json()
+    assert data["subscription"]["state"] == data["host"]["state"] == "open"
+    assert data["host"]["host"] == "example.com"
+    assert data["subscription"]["failures"] == 2
+
+    # parked, not delivered
+    await dispatch("p", sub.id)
+    assert len(rmock.requests[("POST", URL_)]) == 2
+    assert queue().scheduled_job_registry.count == 1
+
+    # the trial delivery fails too, the budget is exhausted
+    half_open("subscription", 1)
+    half_open("host", "example.com")
+    with pytest.raises(ClientResponseError):
+        await dispatch("p", sub.id)
+    assert not (await Subscription.get(1)).active
+    resp = await client.get("/api/subscriptions/1/breaker/")
+    assert (await resp.json())["subscription"]["state"] == "deactivated"
+
+    # dropped
+    await dispatch("p", sub.id)
+    assert len(rmock.requests[("POST", URL_)]) == 3
+
+
+async def test_breaker_half_open_success(client, rmock, subscription, breaker_config):
+    """A successful trial delivery closes the circuits"""
+    await subscription()
+    sub = await Subscription.get(1)
+    payloads.store_many([("p", "test.event.subevent", b"{}")])
+    rmock.post("http://example.com", status=500)
+    rmock.post("http://example.com", status=500)
+    rmock.post("http://example.com")
+    for _ in range(2):
+        with pytest.raises(ClientResponseError):
+            await dispatch("p", sub.id)
+    half_open("subscription", 1)
+    half_open("host", "example.com")
+    assert breaker.check(1, "example.com") == (breaker.HALF_OPEN, 0)
+    # a single trial at a time
+    assert breaker.check(1, "example.com")[0] == breaker.OPEN
+    queue().connection.delete(f"{breaker.key('subscription', 1)}:trial",
+                              f"{breaker.key('host', 'example.com')}:trial")
+
+    await dispatch("p", sub.id)
+    assert breaker.check(1, "example.com") == (breaker.CLOSED, 0)
+    resp = await client.get("/api/subscriptions/1/breaker/")
+    assert (await resp.json())["subscription"] == {
+        "state": "closed", "failures": 0, "opened_until": None,
+    }
@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from yarl import URL
+
+from chatelet import coalesce
+from chatelet import tracing
+from chatelet.dispatch import fanout_coalesced
+from chatelet.queue import queue
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def coalesced(mocker):
+    mocker.patch.dict("chatelet.events.context", {"checked_at": float("inf"), "registry": {
+        "test.event.subevent": {
+            "event": "test.event.subevent", "secret": os.getenv("TEST_SECRET"),
+            "queue": "default", "priority": 1,
+            "coalesce_key": "$.resource.id", "coalesce_window": 10,
+        },
+    }})
+
+
+def test_key_value():
+    assert coalesce.key_value("$.resource.id", {"resource": {"id": 1}}) == "1"
+    assert coalesce.key_value("$.resource.id", {"resource": {"id": "1"}}) == '"1"'
+    assert coalesce.key_value("$.resource.id", {"resource": {}}) is None
+
+
+async def test_coalesce(rmock, subscription, publication, coalesced):
+    """Within the window, only the last publication of a key is dispatched"""
+    await subscription()
+    rmock.post("http://example.com", repeat=True)
+    ids = []
+    for version in range(3):
+        resp = await publication(payload={"resource": {"id": "a"}, "version": version})
+        assert resp.status == 201
+        ids.append((await resp.json())["id"])
+    assert tracing.get(ids[0])["coalesced"] == "replaced"
+    assert tracing.get(ids[1])["replaced_by"] == ids[2]
+    assert tracing.get(ids[2])["coalesced"] == "held"
+    await publication(payload={"resource": {"id": "b"}, "version": 0})
+    # not coalesced, dispatched right away
+    await publication(payload={"version": 0})
+
+    r = rmock.requests[("POST", URL("http://example.com"))]
+    assert len(r) == 1
+    jobs = queue().scheduled_job_registry.get_job_ids()
+    assert len(jobs) == 2
+    assert sorted(queue().fetch_job(j).args for j in jobs) == [
+        ("test.event.subevent", '"a"'), ("test.event.subevent", '"b"'),
+    ]
+
+    await fanout_coalesced("test.event.subevent", '"a"')
+    assert json.loads(r[-1].kwargs["data"])["payload"] == {"resource": {"id": "a"}, "version": 2}
+    # window closed
+    await fanout_coalesced("test.event.subevent", '"a"')
+    assert len(r) == 2
+    await publication(payload={"resource": {"id": "a"}, "version": 3})
+    assert queue().scheduled_job_registry.count == 3
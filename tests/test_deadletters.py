@@ -0,0 +1,65 @@
+import pytest
+
+from yarl import URL
+
+from chatelet import deadletters
+from chatelet import payloads
+from chatelet.db import Subscription
+from chatelet.queue import queue
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_list_and_redrive(client, rmock, mocker, subscription):
+    mocker.patch("chatelet.config.DEAD_LETTER_REDRIVE_RATE", 2)
+    await subscription()
+    await subscription(url="http://example.com/other")
+    for i in range(3):
+        payloads.store_many([(f"p{i}", "test.event.subevent", b"{}")])
+        await deadletters.bury("chatelet.dispatch.dispatch", (f"p{i}", 1), "boom")
+    await deadletters.bury("chatelet.dispatch.dispatch_batch", (2, ["p0"]), "bam")
+
+    resp = await client.get("/api/deadletters/")
+    data = await resp.json()
+    assert data["count"] == 4
+    assert data["hosts"] == [{"host": "example.com", "count": 4}]
+    assert [s["count"] for s in data["subscriptions"]] == [3, 1]
+    resp = await client.get("/api/deadletters/?subscription=2")
+    assert (await resp.json())["count"] == 1
+
+    resp = await client.post("/api/deadletters/redrive/", json={})
+    assert resp.status == 422
+    rmock.post("http://example.com", repeat=True)
+    resp = await client.post("/api/deadletters/redrive/", json={"subscription": 1})
+    assert resp.status == 202
+    assert await resp.json() == {"subscriptions": [1], "count": 3, "inactive": []}
+    # rate limited: the oldest two now, the next batch in a second
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 2
+    assert queue().scheduled_job_registry.count == 1
+    assert deadletters.summary([1])[0]["count"] == 1
+
+    await deadletters.redrive(1)
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 3
+    assert deadletters.summary([1]) == []
+    assert deadletters.subscriptions() == [2]
+
+
+async def test_redrive_inactive(client, subscription):
+    """Dead letters of inactive subscriptions are not redriven"""
+    await subscription()
+    await subscription(url="http://example.com/other")
+    for sub_id in (1, 2):
+        await deadletters.bury("chatelet.dispatch.dispatch", ("p", sub_id), "boom")
+    await Subscription.update.values(active=False).where(Subscription.id == 2).gino.status()
+
+    resp = await client.post("/api/deadletters/redrive/", json={"subscription": 2})
+    assert resp.status == 409
+    resp = await client.post("/api/deadletters/redrive/", json={"host": "example.com"})
+    assert resp.status == 202
+    assert await resp.json() == {"subscriptions": [1], "count": 1, "inactive": [2]}
+    assert [item["subscription"] for item in deadletters.summary([1, 2])] == [2]
+
+
+async def test_not_a_delivery():
+    assert not await deadletters.bury("chatelet.dispatch.fanout", ({},), "boom")
+    assert (await Subscription.query.gino.all()) == []
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from chatelet import events
+
+TREE = {
+    "ns": {
+        "secret": "${TEST_SECRET}",
+        "queue": "ns",
+        "priority": 2,
+        "dataset": {
+            "created": None,
+            "private": {
+                "secret": "other",
+                "created": None,
+            },
+        },
+    },
+    "nosecret": {"event": None},
+}
+
+
+def test_compile():
+    registry = events.compile(TREE)
+    assert registry["ns.dataset.created"] == {
+        "event": "ns.dataset.created",
+        "secret": os.getenv("TEST_SECRET"),
+        "queue": "ns",
+        "priority": 2,
+        "coalesce_key": None,
+        "coalesce_window": None,
+    }
+    assert registry["ns.dataset"]["secret"] == os.getenv("TEST_SECRET")
+    assert registry["ns.dataset.private.created"]["secret"] == "other"
+    assert registry["nosecret.event"]["secret"] is None
+    assert registry["nosecret.event"]["queue"] == "default"
+    assert "ns.dataset.secret" not in registry
+    with pytest.raises(TypeError):
+        registry["ns.dataset.created"]["secret"] = "nope"
+
+
+def test_get():
+    assert events.get("test.event.subevent")["secret"] == os.getenv("TEST_SECRET")
+    assert events.get("test.event")
+    assert events.get("test.event.unknown") is None
+    assert events.get("test.event.subevent.unknown") is None
+    assert events.get("unknown") is None
+
+
+def test_reload(tmp_path, mocker):
+    efile = tmp_path / "events.yml"
+    efile.write_text("events:\n  ns:\n    one:\n")
+    mocker.patch("chatelet.config.EVENTS_FILE", str(efile))
+    mocker.patch("chatelet.config.EVENTS_RELOAD_INTERVAL", 0)
+    mocker.patch.dict("chatelet.events.context", clear=True)
+    assert events.get("ns.one")
+    assert events.get("ns.two") is None
+
+    efile.write_text("events:\n  ns:\n    one:\n    two:\n")
+    os.utime(efile, (0, 0))
+    assert events.get("ns.two")
+
+    # a broken file keeps the previous events
+    efile.write_text("events: [")
+    os.utime(efile, (1, 1))
+    assert events.get("ns.two")
+
+    # so does a missing one, until it is back
+    efile.unlink()
+    assert events.get("ns.two")
+    efile.write_text("events:\n  ns:\n    three:\n")
+    assert events.get("ns.three")
@@ -0,0 +1,71 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from chatelet import history
+from chatelet.db import Delivery, Publication, Subscription
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_delivery_log(client, rmock, subscription, publication):
+    """Publications and deliveries are logged, and can be listed"""
+    await subscription()
+    await subscription(url="http://example.com/other")
+    rmock.post("http://example.com")
+    rmock.post("http://example.com/other")
+    resp = await publication()
+    assert resp.status == 201
+    # buffered until now
+    assert await Delivery.query.gino.all() == []
+    await history.close()
+
+    pub = await Publication.query.gino.one()
+    assert pub.event == "test.event.subevent"
+    assert pub.subscribers == 2
+    deliveries = await Delivery.query.order_by(Delivery.id).gino.all()
+    assert [(d.subscription_id, d.status, d.publication_id) for d in deliveries] == [
+        (1, 200, pub.id),
+        (2, 200, pub.id),
+    ]
+
+    resp = await client.get("/api/deliveries/?subscription=2")
+    assert [d["subscription_id"] for d in await resp.json()] == [2]
+    since = (datetime.now(timezone.utc) + timedelta(minutes=1)).isoformat()
+    resp = await client.get("/api/deliveries/", params={"since": since})
+    assert await resp.json() == []
+
+
+async def test_delivery_log_batch_size(client, mocker, subscription):
+    mocker.patch("chatelet.config.DELIVERY_LOG_BATCH_SIZE", 2)
+    await subscription()
+    sub = await Subscription.get(1)
+    history.record_delivery(None, sub, 200, None, 0.1)
+    assert history.deliveries.rows
+    history.record_delivery(None, sub, 500, "Internal Server Error", 0.1)
+    # flush is scheduled, w/o waiting for the interval
+    await asyncio.gather(*history.deliveries._flushes)
+    assert not history.deliveries.rows
+    assert len(await Delivery.query.gino.all()) == 2
+
+
+async def test_publication_log_duplicates(client):
+    """A publication fanned out again is logged once, the rows of its batch are kept"""
+    await Publication.create(id="p0", event="test.event", subscribers=1)
+    for pid in ("p0", "p1", "p1", "p2"):
+        history.record_publication(pid, "test.event", 2)
+    await history.close()
+    pubs = await Publication.query.order_by(Publication.id).gino.all()
+    assert [(p.id, p.subscribers) for p in pubs] == [("p0", 1), ("p1", 2), ("p2", 2)]
+
+
+async def test_delivery_log_purge(client, mocker):
+    old = datetime.now(timezone.utc) - timedelta(days=31)
+    mocker.patch("chatelet.history.PURGE_CHUNK_SIZE", 2)
+    for i in range(3):
+        await Publication.create(id=str(i), event="test.event", created_at=old)
+        await Delivery.create(publication_id=str(i), created_at=old)
+    await Delivery.create(publication_id="new", created_at=datetime.now(timezone.utc))
+    assert await history.purge() == 6
+    assert [d.publication_id for d in await Delivery.query.gino.all()] == ["new"]
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+from chatelet.index import SubscriptionIndex
+
+
+def sub(id, event_filter=None):
+    return SimpleNamespace(id=id, event_filter=event_filter)
+
+
+def test_index_match():
+    index = SubscriptionIndex()
+    index.sync([
+        sub(1),
+        sub(2, '$[?(@.organization = "x")]'),
+        sub(3, '$[?(@.organization = "y")]'),
+        sub(4, '$[?(@.dataset.id = 42)]'),
+        sub(5, "$[?(@.size > 10)]"),
+    ])
+    assert [s.id for s in index.match({"organization": "x"})] == [1, 2]
+    assert [s.id for s in index.match({"dataset": {"id": 42}, "size": 11})] == [1, 4, 5]
+    assert [s.id for s in index.match({"organization": ["x"]})] == [1]
+
+
+def test_index_sync():
+    index = SubscriptionIndex()
+    index.sync([sub(1, '$[?(@.a = "x")]'), sub(2, '$[?(@.a = "x")]')])
+    assert [s.id for s in index.match({"a": "x"})] == [1, 2]
+
+    # 1 changed its filter, 2 is gone
+    index.sync([sub(1, '$[?(@.a = "y")]')])
+    assert index.match({"a": "x"}) == []
+    assert [s.id for s in index.match({"a": "y"})] == [1]
+    assert len(index) == 1
+
+    index.sync([])
+    assert not index.equalities
+    assert not index.subscriptions
@@ -0,0 +1,98 @@
+import pytest
+
+from yarl import URL
+
+from chatelet import latency
+from chatelet import payloads
+from chatelet.dispatch import dispatch
+from chatelet.db import Subscription
+from chatelet.queue import queue
+from chatelet.worker import AsyncWorker
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def latency_config(mocker):
+    mocker.patch("chatelet.config.LATENCY_MIN_SAMPLES", 2)
+    mocker.patch("chatelet.config.LATENCY_EWMA_ALPHA", 0.5)
+    mocker.patch("chatelet.config.SLOW_THRESHOLD", 2)
+
+
+def test_latency_ewma(latency_config):
+    latency.record(1, 4)
+    # not enough samples yet
+    assert latency.get(1) == (None, False)
+    assert latency.record(1, 2) == (3, True)
+    assert latency.get(1) == (3, True)
+    # hysteresis, slow until faster than half the threshold
+    assert latency.record(1, 1) == (2, True)
+    assert latency.get(1) == (2, True)
+    latency.record(1, 0)
+    assert latency.get(1) == (1, False)
+    assert latency.slow_many([1, 2]) == set()
+
+
+def test_latency_concurrent(latency_config, mocker):
+    """A delivery recorded while another one updates the latency is applied after it"""
+    latency.record(1, 10)
+    conn = latency.connection()
+    hmget = conn.pipeline().__class__.hmget
+    raced = []
+
+    def racing_hmget(pipe, *args):
+        result = hmget(pipe, *args)
+        if not raced:
+            # another worker records a delivery between the read and the write
+            raced.append(True)
+            conn.hset(latency.key(1), "latency", 2)
+        return result
+
+    mocker.patch.object(conn.pipeline().__class__, "hmget", racing_hmget)
+    assert latency.record(1, 0) == (1, False)
+    assert latency.read(1)[:2] == (1, 2)
+
+
+def test_latency_timeout(mocker):
+    mocker.patch("chatelet.config.HTTP_TIMEOUT", 15)
+    mocker.patch("chatelet.config.HTTP_TIMEOUT_MIN", 2)
+    mocker.patch("chatelet.config.LATENCY_TIMEOUT_FACTOR", 4)
+    assert latency.timeout(None) == 15
+    assert latency.timeout(0.05) == 2
+    assert latency.timeout(1) == 4
+    assert latency.timeout(10) == 15
+
+
+async def test_slow_lane(rmock, mocker, subscription, publication, latency_config):
+    """Deliveries to slow subscribers go to the slow queue, with a longer timeout"""
+    await subscription()
+    await subscription(url="http://example.com/slow")
+    for _ in range(2):
+        latency.record(2, 3)
+    sub = await Subscription.get(2)
+    payloads.store_many([("p", "test.event.subevent", b"{}")])
+    rmock.post("http://example.com/slow")
+    await dispatch("p", sub.id)
+    r = rmock.requests[("POST", URL("http://example.com/slow"))]
+    assert r[0].kwargs["timeout"].total == 12
+
+    mocker.patch("chatelet.config.EAGER_QUEUES", False)
+    mocker.patch.dict("chatelet.queue.context", clear=True)
+    latency.record(2, 3)
+    latency.record(2, 3)
+    await publication()
+    fanout = queue().jobs[0]
+    queue().remove(fanout)
+    await fanout.func(*fanout.args)
+    assert [j.args[1] for j in queue().jobs] == [1]
+    assert [j.args[1] for j in queue("slow").jobs] == [2]
+
+
+def test_worker_budget():
+    queues = [queue("default"), queue("slow")]
+    worker = AsyncWorker(queues, connection=queue().connection, budgets={"slow": 1})
+    worker.reorder_queues()
+    assert {q.name for q in worker._ordered_queues} == {"default", "slow"}
+    worker._running["slow"] = 1
+    worker.reorder_queues()
+    assert [q.name for q in worker._ordered_queues] == ["default"]
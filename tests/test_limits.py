@@ -0,0 +1,66 @@
+import pytest
+
+from yarl import URL
+
+from chatelet import limits
+from chatelet import payloads
+from chatelet.dispatch import dispatch
+from chatelet.db import Subscription
+from chatelet.queue import queue
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def domain_limits(mocker):
+    mocker.patch("chatelet.config.DOMAIN_LIMITS", {
+        "example.com": {"concurrency": 2, "rate": 1},
+        "api.example.com": {"rate": 10, "burst": 3},
+    })
+
+
+def test_domain_limits(domain_limits):
+    assert limits.domain_limits("example.com")[0] == "example.com"
+    assert limits.domain_limits("www.example.com")[0] == "example.com"
+    assert limits.domain_limits("v1.api.example.com")[0] == "api.example.com"
+    assert limits.domain_limits("notexample.com") == (None, None)
+
+
+def test_concurrency(domain_limits):
+    first = limits.acquire_slot("example.com", 2)
+    assert limits.acquire_slot("example.com", 2)
+    assert limits.acquire_slot("example.com", 2) is None
+    limits.release("example.com", first)
+    assert limits.acquire_slot("example.com", 2)
+
+
+def test_token_bucket(domain_limits):
+    assert [limits.take_token("api.example.com", 10, 3) for _ in range(3)] == [0, 0, 0]
+    assert 0 < limits.take_token("api.example.com", 10, 3) <= 0.1
+    # tokens are reserved ahead, waits are spread at the rate
+    assert 0.1 < limits.take_token("api.example.com", 10, 3, ticket="a") <= 0.2
+    assert 0.2 < limits.take_token("api.example.com", 10, 3) <= 0.3
+    # the reserved token is taken when coming back
+    assert limits.take_token("api.example.com", 10, 3, ticket="a") == 0
+    assert limits.take_token("api.example.com", 10, 3, ticket="a") > 0.3
+
+
+async def test_dispatch_rate_limited(client, rmock, subscription, domain_limits):
+    """A delivery over the rate limit is delayed, with all its retries"""
+    await subscription()
+    sub = await Subscription.get(1)
+    payloads.store_many([("p", "test.event.subevent", b"{}")])
+    rmock.post("http://example.com", repeat=True)
+    await dispatch("p", sub.id)
+    await dispatch("p", sub.id)
+
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 1
+    registry = queue().scheduled_job_registry
+    assert registry.count == 1
+    job = queue().fetch_job(registry.get_job_ids()[0])
+    assert job.retries_left == 3
+    # the concurrency slot was released
+    assert queue().connection.zcard(limits.key("concurrency", "example.com")) == 0
+    # its token was reserved
+    await job.func(*job.args)
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 2
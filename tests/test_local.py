@@ -0,0 +1,101 @@
+import asyncio
+import json
+from datetime import timedelta
+
+import pytest
+
+from yarl import URL
+
+from chatelet import local
+from chatelet.queue import queue
+
+pytestmark = pytest.mark.asyncio
+
+
+async def failing():
+    raise ValueError()
+
+
+@pytest.fixture
+async def backend(mocker, tmp_path):
+    mocker.patch("chatelet.config.QUEUE_BACKEND", "local")
+    mocker.patch("chatelet.config.LOCAL_QUEUE_FILE", str(tmp_path / "jobs.wal"))
+    mocker.patch.dict("chatelet.queue.context", clear=True)
+    await local.start()
+    yield
+    await local.stop()
+
+
+async def test_publish(client, rmock, backend, subscription, publication):
+    """Jobs run in the app, publishing does not wait for the deliveries"""
+    await subscription()
+    rmock.post("http://example.com", repeat=True)
+    resp = await publication(payload={"a": 1})
+    assert resp.status == 201
+    assert ("POST", URL("http://example.com")) not in rmock.requests
+
+    await local.join()
+    r = rmock.requests[("POST", URL("http://example.com"))]
+    assert json.loads(r[0].kwargs["data"])["payload"] == {"a": 1}
+    assert not local.jobs
+
+
+async def test_retry(backend, mocker):
+    q = queue()
+    job_id = q.enqueue(failing, retry=mocker.Mock(max=2, intervals=[60]))
+    await local.join()
+    assert local.jobs[job_id]["retries_left"] == 1
+    assert q.count == 0
+
+
+async def test_recover(backend, mocker):
+    """Jobs not done are enqueued again on restart"""
+    q = queue()
+    q.enqueue_in(timedelta(seconds=60), failing)
+    q.enqueue("chatelet.local.ready", "nope")
+    await local.join()
+    await local.stop()
+
+    spy = mocker.spy(local, "put")
+    await local.start()
+    (recovered,), _ = spy.call_args
+    assert [job["func"] for job in recovered] == [f"{__name__}.failing"]
+    assert queue().count == 0
+
+
+async def test_compact(backend, mocker, tmp_path):
+    """The write-ahead file is compacted as jobs are done"""
+    mocker.patch("chatelet.config.LOCAL_QUEUE_COMPACT_EVERY", 10)
+    q = queue()
+    q.enqueue_in(timedelta(seconds=60), failing)
+    for _ in range(20):
+        q.enqueue("chatelet.local.ready", "nope")
+    await local.join()
+    assert local.context["written"] < 10
+    assert [job["func"] for job in local.recover(str(tmp_path / "jobs.wal"))] == [
+        f"{__name__}.failing"
+    ]
+
+
+async def test_bury_failure(backend, mocker):
+    """A job is done even when its dead letters can't be kept, the pool goes on"""
+    mocker.patch("chatelet.deadletters.bury", side_effect=RuntimeError())
+    q = queue()
+    q.enqueue(failing)
+    q.enqueue(failing)
+    await local.join()
+    assert not local.jobs
+    assert all(not task.done() for task in local.context["tasks"])
+
+
+async def test_retention(mocker, tmp_path):
+    """Without workers, the delivery log is purged by the app"""
+    purge = mocker.patch("chatelet.history.purge")
+    mocker.patch("chatelet.config.QUEUE_BACKEND", "local")
+    await local.start()
+    await asyncio.sleep(0)
+    tasks = local.context["tasks"]
+    await local.stop()
+    purge.assert_called_once()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(task.cancelled() for task in tasks)
@@ -0,0 +1,66 @@
+import socket
+
+import pytest
+
+from prometheus_client import REGISTRY
+
+from chatelet import metrics
+
+pytestmark = pytest.mark.asyncio
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def test_metrics(client, rmock, subscription, publication):
+    """Publications and deliveries are measured, and exposed on /metrics"""
+    publishes = sample("chatelet_publish_seconds_count", endpoint="single")
+    deliveries = sample("chatelet_dispatch_seconds_count", host="example.com", status="2xx")
+    errors = sample("chatelet_dispatch_seconds_count", host="example.com", status="5xx")
+    await subscription()
+    await subscription(url="http://example.com/ko")
+    rmock.post("http://example.com")
+    rmock.post("http://example.com/ko", status=500)
+    await publication()
+
+    assert sample("chatelet_publish_seconds_count", endpoint="single") == publishes + 1
+    assert sample(
+        "chatelet_dispatch_seconds_count", host="example.com", status="2xx"
+    ) == deliveries + 1
+    assert sample(
+        "chatelet_dispatch_seconds_count", host="example.com", status="5xx"
+    ) == errors + 1
+
+    resp = await client.get("/metrics")
+    assert resp.status == 200
+    text = await resp.text()
+    assert 'chatelet_queue_depth{queue="default"}' in text
+    assert "chatelet_publication_subscribers_bucket" in text
+    assert "chatelet_filtered_total" in text
+    assert 'chatelet_filter_cache_total{result="miss"}' in text
+    assert "chatelet_filter_cache_size" in text
+
+
+def test_dispatch_duration_children():
+    child = metrics.dispatch_duration("example.org", 204)
+    assert metrics.dispatch_duration("example.org", 201) is child
+    assert metrics.dispatch_duration("example.org", None) is not child
+
+
+async def test_shard_metrics(client, mocker):
+    """Shard queues are measured too"""
+    mocker.patch("chatelet.config.SHARDS", 2)
+    resp = await client.get("/metrics")
+    text = await resp.text()
+    assert 'chatelet_queue_depth{queue="shard:1"}' in text
+    assert 'chatelet_queue_oldest_job_seconds{queue="shard:0"}' in text
+
+
+def test_serve_port_in_use(caplog):
+    """A worker whose metrics port is taken runs without metrics"""
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        sock.listen()
+        metrics.serve(sock.getsockname()[1])
+    assert "Worker metrics not served" in caplog.text
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from yarl import URL
+
+from chatelet import routing
+from chatelet.db import Subscription
+
+pytestmark = pytest.mark.asyncio
+
+
+def test_patterns():
+    assert routing.patterns("a.b.c") == ["a.b.c", "a.b.*", "a.b.**", "a.**"]
+    assert routing.patterns("a") == ["a"]
+
+
+async def test_add_wildcard_subscription(client, subscription):
+    resp = await subscription(event="test.**")
+    assert resp.status == 201
+    resp = await subscription(event="test.event.*")
+    assert resp.status == 201
+    resp = await subscription(event="nope.**")
+    assert resp.status == 404
+
+
+async def test_wildcard_delivery(client, rmock, subscription, publication):
+    """Patterns match the events below them, once per url, most specific first"""
+    await subscription(event="test.event.*", url="http://example.com/children")
+    await subscription(event="test.**", url="http://example.com/all")
+    await subscription(event="test.**", url="http://example.com/children")
+    await subscription(event="test.other.*", url="http://example.com/other")
+    rmock.post("http://example.com/children", repeat=True)
+    rmock.post("http://example.com/all", repeat=True)
+    await publication(payload={"a": 1})
+
+    r = rmock.requests[("POST", URL("http://example.com/children"))]
+    assert len(r) == 1
+    body = json.loads(r[0].kwargs["data"])
+    assert body["event"] == "test.event.subevent"
+    assert body["subscription"] == 1
+    assert body["payload"] == {"a": 1}
+    assert len(rmock.requests[("POST", URL("http://example.com/all"))]) == 1
+    assert ("POST", URL("http://example.com/other")) not in rmock.requests
+
+
+async def test_wildcard_batch(client, rmock, subscription, publication):
+    await subscription(event="test.**", batch_size=2)
+    rmock.post("http://example.com", repeat=True)
+    await publication(payload={"i": 0})
+    await publication(payload={"i": 1})
+
+    r = rmock.requests[("POST", URL("http://example.com"))]
+    body = json.loads(r[0].kwargs["data"])
+    assert body["payloads"] == [{"i": 0}, {"i": 1}]
+    assert body["events"] == ["test.event.subevent"] * 2
+    assert (await Subscription.get(1)).event == "test.**"
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from redis import Redis
+from redis.exceptions import ResponseError
+from yarl import URL
+
+from chatelet import streams
+from chatelet.queue import connection
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def broker(mocker):
+    """Streams on TEST_REDIS_URL if set, fakeredis has no stream commands"""
+    mocker.patch("chatelet.config.BROKER", "streams")
+    mocker.patch.dict("chatelet.streams.context", {"grouped": set()})
+    if os.getenv("TEST_REDIS_URL"):
+        conn = Redis.from_url(os.getenv("TEST_REDIS_URL"))
+        conn.flushdb()
+        mocker.patch.dict("chatelet.queue.context", {"_connection": conn}, clear=True)
+    try:
+        connection().xlen("chatelet:stream:test")
+    except ResponseError:
+        pytest.skip("redis streams not supported by this redis, set TEST_REDIS_URL")
+
+
+def test_next_id():
+    assert streams.next_id("1700000000000-3") == "1700000000000-4"
+    assert streams.next_id("1700000000000") == "1700000000000-1"
+
+
+def test_stream_for():
+    assert streams.stream_for("test.event.subevent") == "chatelet:stream:test"
+    assert "chatelet:stream:test" in streams.streams()
+
+
+async def test_replay_needs_streams(client, subscription):
+    await subscription()
+    resp = await client.post("/api/subscriptions/1/replay/", json={"since": "0"})
+    assert resp.status == 409
+    resp = await client.post("/api/subscriptions/2/replay/", json={"since": "0"})
+    assert resp.status == 404
+
+
+async def test_publish_to_stream(client, rmock, broker, subscription, publication):
+    """Publications go through the stream, acknowledged once fanned out"""
+    await subscription()
+    rmock.post("http://example.com", repeat=True)
+    await publication(payload={"a": 1})
+    assert connection().xlen("chatelet:stream:test") == 1
+    assert ("POST", URL("http://example.com")) not in rmock.requests
+
+    await streams.work("w1", burst=True)
+    r = rmock.requests[("POST", URL("http://example.com"))]
+    assert json.loads(r[0].kwargs["data"])["payload"] == {"a": 1}
+    assert connection().xpending("chatelet:stream:test", streams.GROUP)["pending"] == 0
+
+
+async def test_claim_pending(client, rmock, broker, mocker, subscription, publication):
+    """Entries read by a crashed worker are claimed by another one"""
+    await subscription()
+    rmock.post("http://example.com", repeat=True)
+    await publication()
+    streams.create_groups(streams.streams())
+    assert len(streams.read("crashed", streams.streams())) == 1
+
+    mocker.patch("chatelet.config.STREAM_CLAIM_IDLE", 0)
+    await streams.work("w1", burst=True)
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 1
+    assert connection().xpending("chatelet:stream:test", streams.GROUP)["pending"] == 0
+
+
+async def test_replay(client, rmock, broker, subscription, publication):
+    await subscription(event="test.**", event_filter='$[?(@.a = 2)]')
+    rmock.post("http://example.com", repeat=True)
+    for a in (1, 2, 2):
+        await publication(payload={"a": a})
+    await streams.work("w1", burst=True)
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 2
+
+    since = connection().xrange("chatelet:stream:test")[1][0].decode()
+    resp = await client.post("/api/subscriptions/1/replay/", json={"since": since})
+    assert resp.status == 202
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 4
+    resp = await client.post("/api/subscriptions/1/replay/", json={"since": "nope"})
+    assert resp.status == 422
+
+
+async def test_publish_before_workers(client, rmock, broker, subscription, publication):
+    """Publications appended before any worker started, or to a new namespace, are read"""
+    await subscription()
+    rmock.post("http://example.com", repeat=True)
+    # appended without a consumer group, as before the first deploy of workers
+    connection().xadd("chatelet:stream:test", {
+        "id": "early", "event": "test.event.subevent", "payload": b"{}",
+    })
+    await publication(payload={"a": 1})
+
+    await streams.work("w1", burst=True)
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 2
+
+
+async def test_work_survives_errors(mocker):
+    """Reading the streams goes on after an error"""
+    mocker.patch("chatelet.streams.create_groups")
+    mocker.patch("chatelet.streams.claim", return_value=[])
+    calls = []
+
+    def read(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise ConnectionError()
+        time.sleep(0.01)
+        return []
+
+    mocker.patch("chatelet.streams.read", side_effect=read)
+    consumer = asyncio.create_task(streams.work("w1"))
+    await asyncio.sleep(streams.BACKOFF + 0.2)
+    assert len(calls) > 1
+    assert not consumer.done()
+    consumer.cancel()
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from aiohttp import ClientResponseError
+
+from chatelet import client as http
+from chatelet import utils
+from chatelet.dispatch import dispatch
+
+pytestmark = pytest.mark.asyncio
+
+
+def test_spans():
+    assert http.spans({"start": 1, "sent": 1.5, "end": 3}) == {"send": 0.5, "response": 1.5}
+    assert http.spans({"start": 1}) == {}
+
+
+async def test_publication_status(client, rmock, subscription, publication):
+    """A publication id is returned, its status has spans and a status per subscriber"""
+    await subscription()
+    await subscription(url="http://example.com/filtered", event_filter='$[?(@.a = 2)]')
+    rmock.post("http://example.com")
+    rmock.post("http://example.com/down", status=500)
+    resp = await publication(payload={"a": 1})
+    assert resp.status == 201
+    publication_id = (await resp.json())["id"]
+    await subscription(url="http://example.com/down")
+    with pytest.raises(ClientResponseError):
+        await dispatch(publication_id, 3)
+
+    resp = await client.get(f"/api/publications/{publication_id}/")
+    assert resp.status == 200
+    data = await resp.json()
+    assert data["id"] == publication_id
+    assert data["event"] == "test.event.subevent"
+    assert data["subscribers"] == 1
+    assert set(data["spans"]) == {"validate", "fanout_wait", "resolve", "enqueue"}
+    ok, down = data["deliveries"]
+    assert ok["subscription"] == 1
+    assert ok["status"] == "delivered"
+    assert ok["code"] == 200
+    assert ok["queue_wait"] >= 0
+    assert down["subscription"] == 3
+    assert down["status"] == "failed"
+    assert down["code"] == 500
+
+    resp = await client.get("/api/publications/00000000-0000-0000-0000-000000000000/")
+    assert resp.status == 404
+
+
+async def test_publication_batch_ids(client, subscription):
+    publications = [
+        {"event": "test.event.subevent", "payload": {}},
+        {"event": "not.registered", "payload": {}},
+    ]
+    resp = await client.post("/api/publications/batch/", json=publications, headers={
+        "x-hook-signature": utils.sign(publications, os.getenv("TEST_SECRET")),
+    })
+    created, missing = await resp.json()
+    assert "id" not in missing
+    resp = await client.get(f"/api/publications/{created['id']}/")
+    data = await resp.json()
+    assert data["subscribers"] == 0
+    assert data["deliveries"] == []
@@ -0,0 +1,258 @@
+import json
+import os
+
+import pytest
+
+from yarl import URL
+
+from chatelet import deadletters
+from chatelet import payloads
+from chatelet import utils
+from chatelet.dispatch import dispatch
+from chatelet.db import Subscription
+from chatelet.queue import queue, retry, weights as queue_weights
+from chatelet.worker import AsyncWorker, ShardWorker
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def async_queue(mocker):
+    mocker.patch("chatelet.config.EAGER_QUEUES", False)
+    mocker.patch.dict("chatelet.queue.context", clear=True)
+    return queue()
+
+
+async def run_worker(queue, worker_class=AsyncWorker, **kwargs):
+    worker = worker_class([queue], connection=queue.connection, **kwargs)
+    await worker.work_async(burst=True, with_scheduler=False)
+    return worker
+
+
+async def test_worker_dispatch(rmock, subscription, async_queue):
+    """Deliveries queued in rq are performed concurrently by the async worker"""
+    await subscription()
+    sub = await Subscription.get(1)
+    rmock.post("http://example.com", repeat=True)
+    for i in range(5):
+        payloads.store_many([(f"p{i}", sub.event, utils.dumps({"i": i}))])
+        async_queue.enqueue(dispatch, f"p{i}", sub.id, retry=retry)
+
+    worker = await run_worker(async_queue, concurrency=2)
+
+    r = rmock.requests[("POST", URL("http://example.com"))]
+    assert sorted(json.loads(call.kwargs["data"])["payload"]["i"] for call in r) == list(range(5))
+    assert async_queue.count == 0
+    assert async_queue.finished_job_registry.count == 5
+    assert worker.failed_job_count == 0
+
+
+async def test_worker_dispatch_failure(rmock, subscription, async_queue):
+    """A failed delivery is scheduled for retry, not lost"""
+    await subscription()
+    sub = await Subscription.get(1)
+    rmock.post("http://example.com", status=500)
+    payloads.store_many([("p", sub.event, b"{}")])
+    job = async_queue.enqueue(dispatch, "p", sub.id, retry=retry)
+
+    await run_worker(async_queue)
+
+    assert async_queue.scheduled_job_registry.get_job_ids() == [job.id]
+    job.refresh()
+    assert job.retries_left == retry.max - 1
+
+
+async def test_exhausted_delivery(rmock, subscription, async_queue):
+    """A delivery failed after all its retries becomes a dead letter"""
+    await subscription()
+    rmock.post("http://example.com", status=500)
+    payloads.store_many([("p", "test.event.subevent", b"{}")])
+    async_queue.enqueue(dispatch, "p", 1)
+
+    await run_worker(async_queue)
+
+    assert async_queue.failed_job_registry.count == 0
+    [dead] = deadletters.summary(deadletters.subscriptions("example.com"))
+    assert dead["subscription"] == 1
+    assert dead["count"] == 1
+    assert "500" in dead["error"]
+
+
+async def test_publish_fanout(rmock, subscription, publication, async_queue):
+    """Publishing enqueues a single fan-out job, which enqueues the deliveries"""
+    for i in range(3):
+        await subscription(url=f"http://example.com/{i}")
+        rmock.post(f"http://example.com/{i}")
+
+    resp = await publication()
+    assert resp.status == 201
+    assert async_queue.count == 1
+    assert async_queue.jobs[0].func_name == "chatelet.dispatch.fanout"
+
+    await run_worker(async_queue)
+
+    for i in range(3):
+        assert ("POST", URL(f"http://example.com/{i}")) in rmock.requests
+    assert async_queue.finished_job_registry.count == 4
+
+
+def test_weighted_fairness(async_queue):
+    """Queues come first in proportion to their weight, validation always first"""
+    queues = [queue(name) for name in ("validation", "default", "busy")]
+    worker = AsyncWorker(queues, connection=async_queue.connection,
+                         weights={"busy": 3}, first=["validation"])
+    heads = []
+    for _ in range(8):
+        worker.reorder_queues()
+        assert worker._ordered_queues[0].name == "validation"
+        heads.append(worker._ordered_queues[1].name)
+    assert heads.count("busy") == 6
+    assert heads.count("default") == 2
+
+
+async def test_namespace_queues(rmock, subscription, publication, async_queue, mocker):
+    """Deliveries go to the queue of their event, validations to their own queue"""
+    mocker.patch("chatelet.config.VALIDATION_OF_INTENT", True)
+    mocker.patch.dict("chatelet.events.context", {"checked_at": float("inf"), "registry": {
+        "test.event.subevent": {
+            "event": "test.event.subevent", "secret": os.getenv("TEST_SECRET"),
+            "queue": "test", "priority": 2,
+        },
+    }})
+    rmock.post("http://example.com")
+    await subscription()
+    assert queue("validation").count == 1
+
+    await publication()
+    assert queue("test").count == 1
+    assert queue_weights() == {"default": 1, "test": 2}
+
+
+async def test_delivery_jobs_carry_ids(rmock, subscription, publication, async_queue):
+    """The payload is stored once, delivery jobs only carry ids"""
+    await subscription()
+    await subscription(url="http://example.com/1")
+    rmock.post("http://example.com")
+    rmock.post("http://example.com/1")
+    await publication(payload={"big": "x" * 1000})
+    fanout = async_queue.jobs[0]
+    async_queue.remove(fanout)
+    await fanout.func(*fanout.args)
+
+    publication_id = fanout.args[0]["id"]
+    assert [job.args for job in async_queue.jobs] == [(publication_id, 1), (publication_id, 2)]
+    payloads.cache.clear()
+    event, payload = payloads.get(publication_id)
+    assert json.loads(payload) == {"big": "x" * 1000}
+    assert 0 < async_queue.connection.ttl(payloads.key(publication_id)) <= 24 * 3600
+
+    await run_worker(async_queue)
+    assert ("POST", URL("http://example.com/1")) in rmock.requests
+
+
+async def test_shard_order(rmock, mocker, subscription, publication, async_queue):
+    """Deliveries to a subscription go to its shard, delivered in order with retries"""
+    mocker.patch("chatelet.config.SHARDS", 4)
+    await subscription()
+    await subscription(url="http://example.com/other")
+    rmock.post("http://example.com", status=500)
+    rmock.post("http://example.com", repeat=True)
+    rmock.post("http://example.com/other", repeat=True)
+    for i in range(3):
+        await publication(payload={"i": i})
+    for fanout in async_queue.jobs:
+        async_queue.remove(fanout)
+        await fanout.func(*fanout.args)
+    shard = queue("shard:1")
+    assert shard.count == 3
+    assert queue("shard:2").count == 3
+    for job in shard.jobs:
+        job.retry_intervals = [0]
+        job.save()
+
+    await run_worker(shard, worker_class=ShardWorker, concurrency=3)
+    r = rmock.requests[("POST", URL("http://example.com"))]
+    assert [json.loads(call.kwargs["data"])["payload"]["i"] for call in r] == [0, 0, 1, 2]
+    assert shard.count == 0
+    assert shard.scheduled_job_registry.count == 0
+
+
+@pytest.mark.parametrize("blocked", ["failed", "parked"])
+async def test_shard_lines(rmock, mocker, subscription, publication, async_queue, blocked):
+    """A subscription waiting for a retry or parked does not hold the concurrency slots"""
+    mocker.patch("chatelet.config.SHARDS", 1)
+    await subscription()
+    await subscription(url="http://example.com/other")
+    posted = []
+
+    def log(url, **kwargs):
+        posted.append((url.path, json.loads(kwargs["data"])["payload"]["i"]))
+
+    if blocked == "failed":
+        rmock.post("http://example.com", status=500, callback=log)
+    else:
+        mocker.patch("chatelet.dispatch.limits.acquire",
+                     side_effect=[(None, 0.3)] + [(None, 0)] * 6)
+    rmock.post("http://example.com", repeat=True, callback=log)
+    rmock.post("http://example.com/other", repeat=True, callback=log)
+    for i in range(3):
+        await publication(payload={"i": i})
+    for fanout in async_queue.jobs:
+        async_queue.remove(fanout)
+        await fanout.func(*fanout.args)
+    shard = queue("shard:0")
+    for job in shard.jobs:
+        job.retry_intervals = [0.3]
+        job.save()
+
+    await run_worker(shard, worker_class=ShardWorker, concurrency=1)
+    failed = [("/", 0)] if blocked == "failed" else []
+    assert posted == failed + [("/other", 0), ("/other", 1), ("/other", 2),
+                               ("/", 0), ("/", 1), ("/", 2)]
+    assert shard.finished_job_registry.count == 6
+    # parked deliveries keep their retries
+    retries = [shard.fetch_job(job_id).retries_left
+               for job_id in shard.finished_job_registry.get_job_ids()]
+    assert sorted(retries) == [2] * len(failed) + [3] * (6 - len(failed))
+
+
+async def test_shard_line_cap(rmock, mocker, subscription, publication, async_queue):
+    """A busy line stops the dequeuing of its shard, its waiting deliveries are registered"""
+    mocker.patch("chatelet.config.SHARDS", 1)
+    mocker.patch("chatelet.config.SHARD_LINE_SIZE", 2)
+    await subscription()
+    rmock.post("http://example.com", repeat=True)
+    for i in range(5):
+        await publication(payload={"i": i})
+    for fanout in async_queue.jobs:
+        async_queue.remove(fanout)
+        await fanout.func(*fanout.args)
+    shard = queue("shard:0")
+    seen = []
+
+    def acquire(host, ticket=None):
+        seen.append((shard.count, shard.started_job_registry.count))
+        return None, 0.3 if len(seen) == 1 else 0
+
+    mocker.patch("chatelet.dispatch.limits.acquire", side_effect=acquire)
+    await run_worker(shard, worker_class=ShardWorker, concurrency=3)
+    # back from parking: the head and the one waiting in line, the others left in redis
+    assert seen[1] == (3, 2)
+    assert len(rmock.requests[("POST", URL("http://example.com"))]) == 5
+    assert shard.started_job_registry.count == 0
+
+
+async def test_park_keeps_retries(rmock, mocker, subscription, async_queue):
+    """A delivery parked again keeps the retries it has left"""
+    await subscription()
+    sub = await Subscription.get(1)
+    payloads.store_many([("p", sub.event, b"{}")])
+    mocker.patch("chatelet.dispatch.breaker.check", return_value=("open", 30))
+    job = async_queue.enqueue(dispatch, "p", sub.id, retry=retry)
+    job.retries_left = 1
+    job.save()
+
+    await run_worker(async_queue)
+    parked, = [async_queue.fetch_job(job_id)
+               for job_id in async_queue.scheduled_job_registry.get_job_ids()]
+    assert parked.retries_left == 1